@@ -10,4 +10,4 @@ echo "PostgreSQL started"
 
 python manage.py recreate_db
 python manage.py seed_db
-gunicorn -b 0.0.0.0:5000 manage:app
+gunicorn -c gunicorn_config.py manage:app
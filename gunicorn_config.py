@@ -0,0 +1,42 @@
+# gunicorn_config.py
+
+
+import os
+import subprocess
+import sys
+
+
+bind = '0.0.0.0:5000'
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+# concurrent greenlets per worker; size SQLALCHEMY_POOL_SIZE +
+# SQLALCHEMY_MAX_OVERFLOW to the share of these that hit the database
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+
+def on_starting(server):
+    # calibrate bcrypt once, in a separate process so the master does not
+    # import the app; workers import the config after forking and all read
+    # the same BCRYPT_LOG_ROUNDS (this relies on preload_app staying off)
+    if float(os.environ.get('BCRYPT_TARGET_MS', 0)) and \
+            'BCRYPT_LOG_ROUNDS' not in os.environ:
+        output = subprocess.check_output(
+            [sys.executable, 'manage.py', 'calibrate_bcrypt'])
+        os.environ['BCRYPT_LOG_ROUNDS'] = output.split()[-1].decode()
+        server.log.info(
+            'bcrypt cost calibrated to %s', os.environ['BCRYPT_LOG_ROUNDS'])
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # make psycopg2 yield to the hub while it waits on postgres
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        server.log.info('psycopg2 patched for gevent (pid %s)', worker.pid)
+
+
+def child_exit(server, worker):
+    # drop the dead worker's live gauges from the multiprocess directory
+    if 'prometheus_multiproc_dir' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
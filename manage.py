@@ -1,14 +1,24 @@
 # manage.py
 
 
+import datetime
+import json
+import os
+import sys
 import unittest
+from concurrent.futures import ProcessPoolExecutor
+
 import coverage
+from sqlalchemy import func
 
 from flask_script import Manager
 from flask_migrate import MigrateCommand
 
-from project import create_app, db
-from project.api.models import User
+from project import bench as benchmarks, create_app, db
+from project.api import bulk
+from project.api.models import RevokedToken, User
+from project.hashing import calibrate_log_rounds, generate_password_hashes
+from project.keys import generate_private_key_pem
 
 
 COV = coverage.coverage(
@@ -26,9 +36,12 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
-@manager.command
-def test():
+@manager.option('-w', '--workers', dest='workers', type=int, default=1,
+                help='Test processes, each with its own database')
+def test(workers=1):
     """Runs the unit tests without test coverage."""
+    if workers > 1:
+        return 0 if run_parallel(workers) else 1
     tests = unittest.TestLoader().discover('project/tests', pattern='test*.py')
     result = unittest.TextTestRunner(verbosity=2).run(tests)
     if result.wasSuccessful():
@@ -36,12 +49,20 @@ def test():
     return 1
 
 
-@manager.command
-def cov():
+@manager.option('-w', '--workers', dest='workers', type=int, default=1,
+                help='Test processes, each with its own database')
+def cov(workers=1):
     """Runs the unit tests with coverage."""
-    tests = unittest.TestLoader().discover('project/tests')
-    result = unittest.TextTestRunner(verbosity=2).run(tests)
-    if result.wasSuccessful():
+    if workers > 1:
+        successful = run_parallel(workers, cov=True)
+        COV.stop()
+        # merge the data files saved by the workers into this process
+        COV.combine()
+    else:
+        tests = unittest.TestLoader().discover('project/tests')
+        successful = unittest.TextTestRunner(
+            verbosity=2).run(tests).wasSuccessful()
+    if successful:
         COV.stop()
         COV.save()
         print('Coverage Summary:')
@@ -52,6 +73,43 @@ def cov():
     return 1
 
 
+@manager.option('modules', nargs='+', help='Test modules to run')
+@manager.option('--cov', dest='cov', action='store_true', default=False,
+                help='Save coverage data for the parent to combine')
+def test_shard(modules, cov=False):
+    """Runs some test modules; used by test and cov --workers."""
+    tests = unittest.TestLoader().loadTestsFromNames(modules)
+    result = unittest.TextTestRunner(verbosity=2).run(tests)
+    if cov:
+        COV.stop()
+        # a unique data file per worker
+        COV.data_suffix = True
+        COV.save()
+    if result.wasSuccessful():
+        return 0
+    return 1
+
+
+def run_parallel(workers, cov=False):
+    """Runs the test modules on workers processes - :return: boolean"""
+    # only the test commands need the tests package
+    from project.tests import parallel
+    tests = unittest.TestLoader().discover(
+        'project/tests', pattern='test*.py', top_level_dir='.')
+    shards = parallel.split_modules(tests, workers)
+    base_url = os.environ.get('DATABASE_TEST_URL')
+    urls = [parallel.shard_url(base_url, n)
+            for n in range(1, len(shards) + 1)]
+    command = [sys.executable, os.path.abspath(__file__), 'test_shard']
+    if cov:
+        command.append('--cov')
+    parallel.create_databases(base_url, urls)
+    try:
+        return parallel.run_shards(command, shards, urls)
+    finally:
+        parallel.drop_databases(base_url, urls)
+
+
 @manager.command
 def recreate_db():
     """Recreates a database."""
@@ -76,5 +134,96 @@ def seed_db():
     db.session.commit()
 
 
+@manager.option('path', help='CSV or NDJSON (.ndjson/.jsonl) file of users')
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='Processes used to hash plain passwords')
+def import_users(path, workers=None):
+    """Bulk imports users from a CSV or NDJSON file."""
+    parser = bulk.parse_csv if path.endswith('.csv') else bulk.parse_ndjson
+    rounds = app.config.get('BCRYPT_LOG_ROUNDS')
+    with open(path, newline='') as f, ProcessPoolExecutor(workers) as pool:
+        report = bulk.import_users(
+            parser(f),
+            lambda passwords: generate_password_hashes(
+                pool, passwords, rounds),
+            app.config.get('USERS_IMPORT_BATCH_SIZE'))
+    for problem in report['errors'] + report['conflicts']:
+        print(f'line {problem["line"]}: {problem["message"]}')
+    print(f'Imported {report["inserted"]} users, '
+          f'{len(report["conflicts"])} conflicts, '
+          f'{len(report["errors"])} errors.')
+
+
+@manager.option('-s', '--size', dest='size', type=int, default=1000,
+                help='Number of users seeded for the run')
+@manager.option('-n', '--iterations', dest='iterations', type=int,
+                default=1000)
+@manager.option('-b', '--bcrypt-iterations', dest='bcrypt_iterations',
+                type=int, default=5)
+@manager.option('-o', '--output', dest='output', default=None,
+                help='Write the JSON results to this file')
+def bench(size, iterations, bcrypt_iterations, output=None):
+    """Runs the hot path microbenchmarks and prints JSON results."""
+    bench_url = os.environ.get('BENCH_DATABASE_URL')
+    if bench_url:
+        # a dedicated database, whatever APP_SETTINGS points at
+        app.config['SQLALCHEMY_DATABASE_URI'] = bench_url
+        app.config['BENCH_ENABLED'] = True
+    results = json.dumps(
+        benchmarks.run(size, iterations, bcrypt_iterations), indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(results + '\n')
+    print(results)
+
+
+@manager.command
+def hash_costs():
+    """Reports how many password hashes sit at each bcrypt cost."""
+    cost = func.substr(User.password, 5, 2)
+    rows = db.session.query(cost, func.count(User.id)).group_by(
+        cost).order_by(cost).all()
+    print(f'Target cost: {app.config.get("BCRYPT_LOG_ROUNDS")}')
+    for rounds, count in rows:
+        print(f'cost {rounds}: {count} users')
+
+
+@manager.option('-t', '--target-ms', dest='target_ms', type=float,
+                default=None,
+                help='Per-hash budget, BCRYPT_TARGET_MS by default')
+def calibrate_bcrypt(target_ms=None):
+    """Prints the highest bcrypt cost that fits the budget on this host."""
+    target_ms = target_ms or app.config.get('BCRYPT_TARGET_MS')
+    if not target_ms:
+        print('Set BCRYPT_TARGET_MS or pass --target-ms.')
+        return 1
+    print(calibrate_log_rounds(
+        target_ms,
+        app.config.get('BCRYPT_MIN_LOG_ROUNDS'),
+        app.config.get('BCRYPT_MAX_LOG_ROUNDS')))
+
+
+@manager.option('-k', '--kid', dest='kid', default=None,
+                help='Key id, defaults to the current UTC timestamp')
+def generate_jwt_key(kid=None):
+    """Writes a new RS256 signing key to JWT_KEYS_DIR."""
+    kid = kid or datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    path = os.path.join(app.config.get('JWT_KEYS_DIR'), f'{kid}.pem')
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600),
+              'wb') as f:
+        f.write(generate_private_key_pem())
+    print(f'Wrote {path}. Restart the workers to start signing with it.')
+
+
+@manager.command
+def purge_revoked_tokens():
+    """Deletes revoked tokens that have expired anyway."""
+    count = RevokedToken.query.filter(
+        RevokedToken.expires_at <= datetime.datetime.utcnow()
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    print(f'Purged {count} expired revoked tokens.')
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,25 @@
+"""add users (created_at, id) index for keyset pagination
+
+Revision ID: 3c5e1f7d2a90
+Revises: b54a68bcd3d6
+Create Date: 2026-10-18 09:12:04.318211
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c5e1f7d2a90'
+down_revision = 'b54a68bcd3d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_users_created_at_id', 'users', ['created_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_users_created_at_id', table_name='users')
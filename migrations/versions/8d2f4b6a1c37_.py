@@ -0,0 +1,31 @@
+"""add users updated_at
+
+Revision ID: 8d2f4b6a1c37
+Revises: 3c5e1f7d2a90
+Create Date: 2026-10-18 11:40:27.905113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f4b6a1c37'
+down_revision = '3c5e1f7d2a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # backfill existing rows, then leave the value to the application
+    op.add_column('users', sa.Column(
+        'updated_at', sa.DateTime(), nullable=False,
+        server_default=sa.text("(now() at time zone 'utc')")))
+    op.alter_column('users', 'updated_at', server_default=None)
+    op.create_index(
+        'ix_users_updated_at', 'users', ['updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_users_updated_at', table_name='users')
+    op.drop_column('users', 'updated_at')
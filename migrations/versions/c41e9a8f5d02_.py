@@ -0,0 +1,41 @@
+"""add revoked_tokens
+
+Revision ID: c41e9a8f5d02
+Revises: 8d2f4b6a1c37
+Create Date: 2026-10-18 14:02:51.447620
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e9a8f5d02'
+down_revision = '8d2f4b6a1c37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('revoked_tokens',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('digest', sa.String(length=64), nullable=False),
+    sa.Column('revoked_at', sa.DateTime(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('digest')
+    )
+    op.create_index(
+        op.f('ix_revoked_tokens_expires_at'), 'revoked_tokens',
+        ['expires_at'], unique=False)
+    op.create_index(
+        op.f('ix_revoked_tokens_revoked_at'), 'revoked_tokens',
+        ['revoked_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(
+        op.f('ix_revoked_tokens_revoked_at'), table_name='revoked_tokens')
+    op.drop_index(
+        op.f('ix_revoked_tokens_expires_at'), table_name='revoked_tokens')
+    op.drop_table('revoked_tokens')
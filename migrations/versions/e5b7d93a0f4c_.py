@@ -0,0 +1,30 @@
+"""add users lower(email) and active users indexes
+
+Revision ID: e5b7d93a0f4c
+Revises: c41e9a8f5d02
+Create Date: 2026-10-18 17:33:39.582044
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b7d93a0f4c'
+down_revision = 'c41e9a8f5d02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # fails if two existing emails differ only by case; merge those first
+    op.execute(
+        'CREATE UNIQUE INDEX ix_users_email_lower ON users (lower(email))')
+    op.create_index(
+        'ix_users_active_created_at_id', 'users', ['created_at', 'id'],
+        unique=False, postgresql_where=sa.text('active'))
+
+
+def downgrade():
+    op.drop_index('ix_users_active_created_at_id', table_name='users')
+    op.drop_index('ix_users_email_lower', table_name='users')
@@ -0,0 +1,25 @@
+"""drop users updated_at index
+
+Revision ID: f2a8c6d41b93
+Revises: e5b7d93a0f4c
+Create Date: 2026-10-18 18:02:11.417305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a8c6d41b93'
+down_revision = 'e5b7d93a0f4c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index('ix_users_updated_at', table_name='users')
+
+
+def downgrade():
+    op.create_index(
+        'ix_users_updated_at', 'users', ['updated_at'], unique=False)
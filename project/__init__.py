@@ -5,15 +5,30 @@ import os
 
 from flask import Flask, jsonify
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_bcrypt import Bcrypt
 
+from project.admission import AdmissionController
+from project.cache import TTLCache
+from project.hashing import HashingPool
+from project.keys import KeyRing
+from project.metrics import Metrics
+from project.pool import PooledSQLAlchemy
+from project.revocation import RevocationList
+
 
 # instantiate the extensions
-db = SQLAlchemy()
+db = PooledSQLAlchemy()
 migrate = Migrate()
 bcrypt = Bcrypt()
+principal_cache = TTLCache('PRINCIPAL_CACHE')
+token_cache = TTLCache('TOKEN_CACHE')
+response_cache = TTLCache('RESPONSE_CACHE')
+hashing_pool = HashingPool()
+key_ring = KeyRing()
+metrics = Metrics()
+admission = AdmissionController()
+revocation_list = RevocationList()
 
 
 def create_app():
@@ -32,6 +47,14 @@ def create_app():
     db.init_app(app)
     bcrypt.init_app(app)
     migrate.init_app(app, db)
+    principal_cache.init_app(app)
+    token_cache.init_app(app)
+    response_cache.init_app(app)
+    hashing_pool.init_app(app)
+    key_ring.init_app(app)
+    metrics.init_app(app)
+    admission.init_app(app)
+    revocation_list.init_app(app)
 
     # register blueprints
     from project.api.users import users_blueprint
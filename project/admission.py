@@ -0,0 +1,130 @@
+# project/admission.py
+
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, jsonify, request
+
+from project.metrics import ADMISSION_REJECTIONS
+
+
+class TokenBucket:
+    """Refills at rate tokens per second, holding at most burst"""
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate, burst, now):
+        """Takes a token - :return: 0, or seconds until one is available"""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / rate
+
+
+class AdmissionController:
+    """Fails fast on CPU-heavy endpoints instead of queueing requests
+
+    ``ADMISSION_LIMITS`` maps an endpoint name (``auth.login_user``) to its
+    limits: ``concurrency`` requests may run at once in this worker, and
+    each client may start ``rate`` requests per second with bursts of up
+    to ``burst``. Clients are keyed by the remote address or, when
+    ``ADMISSION_CLIENT_HEADER`` is set, by the entry that the outermost of
+    the ``ADMISSION_TRUSTED_HOPS`` proxies appended to that header (the
+    entries left of it come from the client and are ignored); at most
+    ``ADMISSION_MAX_CLIENTS`` buckets are kept, least recently used first
+    out. Over its rate a client gets a 429 and over the
+    concurrency limit a 503, both with ``Retry-After``.
+    """
+
+    def __init__(self):
+        self.limits = {}
+        self.client_header = None
+        self.trusted_hops = 1
+        self.max_clients = 0
+        self._semaphores = {}
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.configure(app.config)
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def configure(self, config):
+        """Loads the limits and drops every bucket and slot"""
+        with self._lock:
+            self.limits = dict(config.get('ADMISSION_LIMITS') or {})
+            self.client_header = config.get('ADMISSION_CLIENT_HEADER')
+            self.trusted_hops = config.get('ADMISSION_TRUSTED_HOPS') or 1
+            self.max_clients = config.get('ADMISSION_MAX_CLIENTS')
+            self._semaphores = {
+                endpoint: threading.BoundedSemaphore(limit['concurrency'])
+                for endpoint, limit in self.limits.items()
+                if limit.get('concurrency')
+            }
+            self._buckets.clear()
+
+    def client_key(self):
+        if self.client_header:
+            # proxies append on the right, the client can forge the left
+            entries = request.headers.get(self.client_header, '').split(',')
+            if len(entries) >= self.trusted_hops:
+                value = entries[-self.trusted_hops].strip()
+                if value:
+                    return value
+        return request.remote_addr
+
+    def admit(self):
+        limit = self.limits.get(request.endpoint)
+        if not limit:
+            return None
+        if limit.get('rate'):
+            wait = self._take(request.endpoint, limit)
+            if wait:
+                return self._reject('rate', 429, wait)
+        semaphore = self._semaphores.get(request.endpoint)
+        if semaphore is not None:
+            if not semaphore.acquire(blocking=False):
+                return self._reject('concurrency', 503, 1)
+            g.admission_semaphore = semaphore
+        return None
+
+    def release(self, exc=None):
+        semaphore = g.pop('admission_semaphore', None)
+        if semaphore is not None:
+            semaphore.release()
+
+    def _take(self, endpoint, limit):
+        rate = limit['rate']
+        burst = limit.get('burst') or rate
+        key = (endpoint, self.client_key())
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(burst, now)
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.take(rate, burst, now)
+
+    def _reject(self, reason, code, retry_after):
+        ADMISSION_REJECTIONS.labels(request.endpoint, reason).inc()
+        if code == 429:
+            message = 'Too many requests. Please try again later.'
+        else:
+            message = 'Server busy. Please try again.'
+        response_object = {
+            'status': 'error',
+            'message': message
+        }
+        return jsonify(response_object), code, {
+            'Retry-After': str(max(1, math.ceil(retry_after)))}
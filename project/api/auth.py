@@ -1,12 +1,13 @@
 # project/api/auth.py
 
 
-from flask import Blueprint, jsonify, request
-from sqlalchemy import exc, or_
+from flask import Blueprint, current_app, jsonify, request
+from sqlalchemy import exc, func
 
-from project.api.utils import authenticate
+from project.api.utils import authenticate, load_principals
 from project.api.models import User
-from project import db, bcrypt
+from project.hashing import HashingPoolFull
+from project import db, hashing_pool, key_ring, revocation_list
 
 
 auth_blueprint = Blueprint('auth', __name__)
@@ -26,32 +27,21 @@ def register_user():
     email = post_data.get('email')
     password = post_data.get('password')
     try:
-        # check for existing user
-        user = User.query.filter(
-            or_(User.username == username, User.email==email)).first()
-        if not user:
-            # add new user to db
-            new_user = User(
-                username=username,
-                email=email,
-                password=password
-            )
-            db.session.add(new_user)
-            db.session.commit()
-            # generate auth token
-            auth_token = new_user.encode_auth_token(new_user.id)
-            response_object = {
-                'status': 'success',
-                'message': 'Successfully registered.',
-                'auth_token': auth_token.decode()
-            }
-            return jsonify(response_object), 201
-        else:
+        user_id, conflict = User.insert_unique(username, email, password)
+        if conflict:
             response_object = {
                 'status': 'error',
                 'message': 'Sorry. That user already exists.'
             }
             return jsonify(response_object), 400
+        # generate auth token
+        auth_token = User.encode_auth_token(user_id)
+        response_object = {
+            'status': 'success',
+            'message': 'Successfully registered.',
+            'auth_token': auth_token.decode()
+        }
+        return jsonify(response_object), 201
     # handler errors
     except (exc.IntegrityError, ValueError) as e:
         db.session().rollback()
@@ -60,6 +50,12 @@ def register_user():
             'message': 'Invalid payload.'
         }
         return jsonify(response_object), 400
+    except HashingPoolFull:
+        response_object = {
+            'status': 'error',
+            'message': 'Server busy. Please try again.'
+        }
+        return jsonify(response_object), 503, {'Retry-After': '1'}
 
 
 @auth_blueprint.route('/auth/login', methods=['POST'])
@@ -76,8 +72,11 @@ def login_user():
     password = post_data.get('password')
     try:
         # fetch the user data
-        user = User.query.filter_by(email=email).first()
-        if user and bcrypt.check_password_hash(user.password, password):
+        user = User.query.filter(
+            func.lower(User.email) == func.lower(email)).first()
+        if user and hashing_pool.check_password_hash(user.password, password):
+            if user.rehash_password(password):
+                db.session.commit()
             auth_token = user.encode_auth_token(user.id)
             if auth_token:
                 response_object = {
@@ -92,6 +91,12 @@ def login_user():
                 'message': 'User does not exist.'
             }
             return jsonify(response_object), 404
+    except HashingPoolFull:
+        response_object = {
+            'status': 'error',
+            'message': 'Server busy. Please try again.'
+        }
+        return jsonify(response_object), 503, {'Retry-After': '1'}
     except Exception as e:
         print(e)
         response_object = {
@@ -104,6 +109,9 @@ def login_user():
 @auth_blueprint.route('/auth/logout', methods=['GET'])
 @authenticate
 def logout_user(resp):
+    auth_token = request.headers.get('Authorization').split(" ")[1]
+    revocation_list.revoke(
+        User.token_digest(auth_token), User.token_expiry(auth_token))
     response_object = {
         'status': 'success',
         'message': 'Successfully logged out.'
@@ -126,3 +134,65 @@ def get_user_status(resp):
         }
     }
     return jsonify(response_object), 200
+
+
+@auth_blueprint.route('/auth/introspect', methods=['POST'])
+def introspect_tokens():
+    """Validate a batch of tokens for downstream services"""
+    response_object = {
+        'status': 'error',
+        'message': 'Invalid payload.'
+    }
+    # get post data
+    post_data = request.get_json()
+    tokens = post_data.get('tokens') if isinstance(post_data, dict) else None
+    if not tokens or not isinstance(tokens, list) or \
+            not all(isinstance(token, str) for token in tokens):
+        return jsonify(response_object), 400
+    max_tokens = current_app.config.get('INTROSPECT_MAX_TOKENS')
+    if len(tokens) > max_tokens:
+        response_object['message'] = f'Too many tokens (max {max_tokens}).'
+        return jsonify(response_object), 400
+    subs = [User.decode_auth_token(token) for token in tokens]
+    revoked = revocation_list.revoked(
+        [User.token_digest(token) for token, sub in zip(tokens, subs)
+         if not isinstance(sub, str)])
+    # every referenced user is loaded in one query
+    principals = load_principals(
+        [sub for sub in subs if not isinstance(sub, str)])
+    results = []
+    for token, sub in zip(tokens, subs):
+        if isinstance(sub, str):
+            results.append({'active': False, 'message': sub})
+            continue
+        if User.token_digest(token) in revoked:
+            results.append({
+                'active': False,
+                'message': 'Token revoked. Please log in again.'
+            })
+            continue
+        principal = principals.get(sub)
+        if not principal or not principal.active:
+            results.append({'active': False, 'sub': sub})
+            continue
+        results.append({
+            'active': True,
+            'sub': sub,
+            'admin': principal.admin
+        })
+    response_object = {
+        'status': 'success',
+        'data': {
+            'tokens': results
+        }
+    }
+    return jsonify(response_object), 200
+
+
+@auth_blueprint.route('/.well-known/jwks.json', methods=['GET'])
+def get_jwks():
+    """Public keys for verifying auth tokens locally"""
+    response = jsonify(key_ring.jwks())
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get('JWKS_MAX_AGE')
+    return response, 200
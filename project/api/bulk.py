@@ -0,0 +1,148 @@
+# project/api/bulk.py
+
+
+import csv
+import datetime
+import json
+import re
+
+from sqlalchemy import func, or_
+from sqlalchemy.dialects.postgresql import insert
+
+from project import db
+from project.api.models import User, invalidate_user_caches
+
+
+# a complete bcrypt hash: anything else fails every later login
+BCRYPT_HASH = re.compile(r'\$2[aby]\$\d\d\$[./A-Za-z0-9]{53}\Z')
+
+
+def parse_csv(lines):
+    """Yields (line, row, error) for a CSV file with a header row"""
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row, None
+
+
+def parse_ndjson(lines):
+    """Yields (line, row, error) for newline-delimited JSON objects"""
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_num, None, 'Invalid JSON.'
+            continue
+        if not isinstance(row, dict):
+            yield line_num, None, 'Invalid JSON.'
+            continue
+        yield line_num, row, None
+
+
+def import_users(rows, hash_passwords, batch_size):
+    """Inserts users in batches, reporting bad rows and conflicts
+
+    Each row needs a username, an email and either a plain ``password``,
+    hashed in bulk with ``hash_passwords``, or a bcrypt ``password_hash``
+    that is stored as is. Without ``hash_passwords`` only pre-hashed rows
+    are accepted. A bad or conflicting row never aborts the rest.
+    """
+    report = {'inserted': 0, 'conflicts': [], 'errors': []}
+    batch = []
+    for line, row, error in rows:
+        error = error or validate_row(row, hash_passwords is not None)
+        if error:
+            report['errors'].append({'line': line, 'message': error})
+            continue
+        batch.append((line, row))
+        if len(batch) >= batch_size:
+            insert_batch(batch, hash_passwords, report)
+            batch = []
+    if batch:
+        insert_batch(batch, hash_passwords, report)
+    return report
+
+
+def validate_row(row, plain_passwords=True):
+    fields = ('username', 'email', 'password', 'password_hash')
+    if not all(isinstance(row.get(f) or '', str) for f in fields):
+        return 'Invalid payload.'
+    if not row.get('username') or not row.get('email'):
+        return 'Invalid payload.'
+    password_hash = row.get('password_hash')
+    if password_hash:
+        if not BCRYPT_HASH.match(password_hash):
+            return 'Invalid password hash.'
+    elif not row.get('password'):
+        return 'Invalid payload.'
+    elif not plain_passwords:
+        return 'Plain passwords are not accepted here; send password_hash.'
+    return None
+
+
+def insert_batch(batch, hash_passwords, report):
+    # conflicts inside the batch itself never reach the database
+    unique, usernames, emails = [], set(), set()
+    for line, row in batch:
+        field = conflicting_field(row, usernames, emails)
+        if field:
+            report['conflicts'].append(conflict(line, row, field))
+            continue
+        usernames.add(row['username'])
+        emails.add(row['email'].lower())
+        unique.append((line, row))
+    if not unique:
+        return
+    plain = [row['password'] for line, row in unique
+             if not row.get('password_hash')]
+    hashes = iter(hash_passwords(plain) if plain else [])
+    now = datetime.datetime.utcnow()
+    values = [{
+        'username': row['username'],
+        'email': row['email'],
+        'password': row.get('password_hash') or next(hashes),
+        'active': True,
+        'admin': False,
+        'created_at': now,
+        'updated_at': now
+    } for line, row in unique]
+    # one multi-row statement per batch; conflicting rows are skipped by
+    # postgres and simply missing from RETURNING
+    inserted = {r.username for r in db.session.execute(
+        insert(User.__table__).values(values).on_conflict_do_nothing(
+        ).returning(User.__table__.c.username))}
+    db.session.commit()
+    invalidate_user_caches()
+    report['inserted'] += len(inserted)
+    skipped = [(line, row) for line, row in unique
+               if row['username'] not in inserted]
+    if not skipped:
+        return
+    existing = db.session.query(User.username, User.email).filter(or_(
+        User.username.in_([row['username'] for line, row in skipped]),
+        func.lower(User.email).in_(
+            [row['email'].lower() for line, row in skipped])
+    )).all()
+    usernames = {user.username for user in existing}
+    emails = {user.email.lower() for user in existing}
+    for line, row in skipped:
+        field = conflicting_field(row, usernames, emails) or 'username'
+        report['conflicts'].append(conflict(line, row, field))
+
+
+def conflicting_field(row, usernames, emails):
+    if row['username'] in usernames:
+        return 'username'
+    if row['email'].lower() in emails:
+        return 'email'
+    return None
+
+
+def conflict(line, row, field):
+    return {
+        'line': line,
+        'username': row['username'],
+        'field': field,
+        'message': f'Sorry. That {field} already exists.'
+    }
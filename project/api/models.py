@@ -2,15 +2,26 @@
 
 
 import datetime
+import hashlib
+import time
 
 import jwt
 from flask import current_app
+from sqlalchemy import event, func, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, object_session
 
-from project import db, bcrypt
+from project import (
+    db, hashing_pool, key_ring, principal_cache, response_cache, token_cache)
+from project.hashing import HashingPoolFull, hash_cost
+from project.metrics import JWT_LATENCY
 
 
 class User(db.Model):
     __tablename__ = "users"
+    __table_args__ = (
+        db.Index('ix_users_created_at_id', 'created_at', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(128), unique=True, nullable=False)
     email = db.Column(db.String(128), unique=True, nullable=False)
@@ -18,18 +29,81 @@ class User(db.Model):
     active = db.Column(db.Boolean, default=True, nullable=False)
     admin = db.Column(db.Boolean, default=False, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
 
     def __init__(
             self, username, email, password,
             created_at=datetime.datetime.utcnow()):
         self.username = username
         self.email = email
-        self.password = bcrypt.generate_password_hash(
-            password, current_app.config.get('BCRYPT_LOG_ROUNDS')
-        ).decode()
+        self.password = hashing_pool.generate_password_hash(
+            password, current_app.config.get('BCRYPT_LOG_ROUNDS'))
         self.created_at = created_at
 
-    def encode_auth_token(self, user_id):
+    @classmethod
+    def conflicting_field(cls, username, email):
+        """Names the unique field already taken - :return: string|None"""
+        # emails are unique regardless of case; a taken email is reported
+        # first, even when the username is taken by another row
+        users = db.session.query(cls.username, cls.email).filter(or_(
+            cls.username == username,
+            func.lower(cls.email) == func.lower(email))).limit(2).all()
+        if not users:
+            return None
+        if any(user.email.lower() == email.lower() for user in users):
+            return 'email'
+        return 'username'
+
+    @classmethod
+    def insert_unique(cls, username, email, password):
+        """Adds and commits a user unless the username or email is taken
+
+        Taken names are found before the password is hashed, so duplicate
+        signups cost no bcrypt time; the insert itself is a single
+        ``INSERT ... ON CONFLICT DO NOTHING RETURNING id``, so a concurrent
+        signup for the same name is reported as a conflict too.
+        :return: (id, None) or (None, conflicting field)
+        """
+        if not username or not email or not password:
+            raise ValueError('Username, email and password are required.')
+        field = cls.conflicting_field(username, email)
+        if field:
+            return None, field
+        pw_hash = hashing_pool.generate_password_hash(
+            password, current_app.config.get('BCRYPT_LOG_ROUNDS'))
+        user_id = db.session.execute(
+            insert(cls.__table__).values(
+                username=username,
+                email=email,
+                password=pw_hash,
+                created_at=datetime.datetime.utcnow()
+            ).on_conflict_do_nothing().returning(cls.__table__.c.id)
+        ).scalar()
+        if user_id is None:
+            db.session.rollback()
+            return None, cls.conflicting_field(username, email) or 'username'
+        db.session.commit()
+        # core inserts skip the mapper events
+        invalidate_user_caches(user_id)
+        return user_id, None
+
+    def rehash_password(self, password):
+        """Rehashes the password if its cost is off-target - :return: boolean"""
+        rounds = current_app.config.get('BCRYPT_LOG_ROUNDS')
+        if hash_cost(self.password) == rounds:
+            return False
+        try:
+            self.password = hashing_pool.generate_password_hash(
+                password, rounds)
+        except HashingPoolFull:
+            # try again on the next login
+            return False
+        return True
+
+    @staticmethod
+    def encode_auth_token(user_id):
         """Generates the auth token"""
         try:
             payload = {
@@ -40,22 +114,83 @@ class User(db.Model):
                 'iat': datetime.datetime.utcnow(),
                 'sub': user_id
             }
-            return jwt.encode(
-                payload,
-                current_app.config.get('SECRET_KEY'),
-                algorithm='HS256'
-            )
+            with JWT_LATENCY.labels('encode').time():
+                return key_ring.encode(payload)
         except Exception as e:
             return e
 
+    @staticmethod
+    def token_digest(auth_token):
+        """Digest identifying a token in caches - :return: bytes"""
+        if isinstance(auth_token, str):
+            auth_token = auth_token.encode()
+        return hashlib.sha256(auth_token).digest()
+
+    @staticmethod
+    def token_expiry(auth_token):
+        """Reads the exp claim of an already verified token - :return: datetime"""
+        payload = jwt.decode(auth_token, verify=False)
+        return datetime.datetime.utcfromtimestamp(payload['exp'])
+
     @staticmethod
     def decode_auth_token(auth_token):
         """Decodes the auth token - :param auth_token: - :return: integer|string"""
+        # verified tokens are remembered until they expire, so repeat
+        # requests skip the signature check
+        key = User.token_digest(auth_token)
+        sub = token_cache.get(key)
+        if sub is not None:
+            return sub
         try:
-            payload = jwt.decode(
-                auth_token, current_app.config.get('SECRET_KEY'))
+            with JWT_LATENCY.labels('decode').time():
+                payload = key_ring.decode(auth_token)
+            token_cache.set(key, payload['sub'], payload['exp'] - time.time())
             return payload['sub']
         except jwt.ExpiredSignatureError:
             return 'Signature expired. Please log in again.'
         except jwt.InvalidTokenError:
             return 'Invalid token. Please log in again.'
+
+
+# expression and partial indexes need the mapped columns
+db.Index('ix_users_email_lower', func.lower(User.email), unique=True)
+db.Index(
+    'ix_users_active_created_at_id', User.created_at, User.id,
+    postgresql_where=User.active)
+
+
+class RevokedToken(db.Model):
+    __tablename__ = "revoked_tokens"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    digest = db.Column(db.String(64), unique=True, nullable=False)
+    revoked_at = db.Column(db.DateTime, nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+def invalidate_user_caches(user_id=None):
+    """Drops everything cached from a user row and the user collection"""
+    if user_id is not None:
+        principal_cache.invalidate(user_id)
+    response_cache.clear()
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def receive_user_write(mapper, connection, target):
+    # invalidate on flush, and again on commit so that nothing a concurrent
+    # reader cached from the pre-commit state outlives the transaction
+    invalidate_user_caches(target.id)
+    object_session(target).info.setdefault(
+        'written_user_ids', set()).add(target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def receive_after_commit(session):
+    for user_id in session.info.pop('written_user_ids', ()):
+        invalidate_user_caches(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def receive_after_rollback(session):
+    session.info.pop('written_user_ids', None)
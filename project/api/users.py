@@ -1,17 +1,40 @@
 # project/api/users.py
 
 
-from flask import Blueprint, jsonify, request
-from sqlalchemy import exc
+from flask import (
+    Blueprint, Response, current_app, json, jsonify, request,
+    stream_with_context)
+from sqlalchemy import exc, tuple_
 
-from project.api.utils import authenticate, is_admin
+from project.api.utils import (
+    authenticate, is_admin, encode_cursor, decode_cursor, make_etag,
+    is_conditional, not_modified, not_modified_response, set_validators)
+from project.api import bulk
 from project.api.models import User
-from project import db
+from project.hashing import HashingPoolFull
+from project import db, response_cache
+
+
+STREAM_MIMETYPE = 'application/x-ndjson'
+USER_FIELDS = ('id', 'username', 'email', 'created_at')
+SINGLE_USER_FIELDS = ('username', 'email', 'created_at')
+INVALID_FIELDS = {
+    'status': 'fail',
+    'message': 'Invalid fields.'
+}
+INVALID_ACTIVE = {
+    'status': 'fail',
+    'message': 'Invalid active filter.'
+}
 
 
 users_blueprint = Blueprint('users', __name__)
 
 
+class InvalidFields(Exception):
+    """Raised when ?fields= names an unknown user field"""
+
+
 @users_blueprint.route('/ping', methods=['GET'])
 def ping_pong():
     return jsonify({
@@ -20,6 +43,15 @@ def ping_pong():
     })
 
 
+@users_blueprint.route('/ping/pool', methods=['GET'])
+def pool_status():
+    """Connection pool statistics for this worker"""
+    return jsonify({
+        'status': 'success',
+        'data': db.pool_stats()
+    })
+
+
 @users_blueprint.route('/users', methods=['POST'])
 @authenticate
 def add_user(resp):
@@ -40,24 +72,18 @@ def add_user(resp):
     email = post_data.get('email')
     password = post_data.get('password')
     try:
-        user = User.query.filter_by(email=email).first()
-        if not user:
-            db.session.add(User(
-                username=username,
-                email=email,
-                password=password))
-            db.session.commit()
-            response_object = {
-                'status': 'success',
-                'message': f'{email} was added!'
-            }
-            return jsonify(response_object), 201
-        else:
+        user_id, conflict = User.insert_unique(username, email, password)
+        if conflict:
             response_object = {
                 'status': 'fail',
-                'message': 'Sorry. That email already exists.'
+                'message': f'Sorry. That {conflict} already exists.'
             }
             return jsonify(response_object), 400
+        response_object = {
+            'status': 'success',
+            'message': f'{email} was added!'
+        }
+        return jsonify(response_object), 201
     except (exc.IntegrityError, ValueError) as e:
         db.session().rollback()
         response_object = {
@@ -65,6 +91,47 @@ def add_user(resp):
             'message': 'Invalid payload.'
         }
         return jsonify(response_object), 400
+    except HashingPoolFull:
+        response_object = {
+            'status': 'error',
+            'message': 'Server busy. Please try again.'
+        }
+        return jsonify(response_object), 503, {'Retry-After': '1'}
+
+
+@users_blueprint.route('/users/import', methods=['POST'])
+@authenticate
+def import_users(resp):
+    """Bulk import users with pre-hashed passwords from a CSV or NDJSON body
+
+    Hashing plain passwords would take over the request hashing pool, so
+    those imports go through ``manage.py import_users`` instead.
+    """
+    if not is_admin(resp):
+        response_object = {
+            'status': 'error',
+            'message': 'You do not have permission to do that.'
+        }
+        return jsonify(response_object), 401
+    parsers = {'text/csv': bulk.parse_csv, STREAM_MIMETYPE: bulk.parse_ndjson}
+    parser = parsers.get(request.mimetype)
+    if not parser:
+        response_object = {
+            'status': 'fail',
+            'message': 'Invalid payload.'
+        }
+        return jsonify(response_object), 400
+    # read the body line by line instead of buffering all of it
+    lines = (line.decode('utf-8', 'replace') for line in request.stream)
+    report = bulk.import_users(
+        parser(lines), None,
+        current_app.config.get('USERS_IMPORT_BATCH_SIZE'))
+    response_object = {
+        'status': 'success',
+        'message': f'{report["inserted"]} users were imported.',
+        'data': report
+    }
+    return jsonify(response_object), 200
 
 
 @users_blueprint.route('/users/<user_id>', methods=['GET'])
@@ -75,40 +142,197 @@ def get_single_user(user_id):
         'message': 'User does not exist'
     }
     try:
-        user = User.query.filter_by(id=int(user_id)).first()
-        if not user:
-            return jsonify(response_object), 404
-        else:
-            response_object = {
-                'status': 'success',
-                'data': {
-                  'username': user.username,
-                  'email': user.email,
-                  'created_at': user.created_at
-                }
-            }
-            return jsonify(response_object), 200
+        user_id = int(user_id)
+        fields = requested_fields(SINGLE_USER_FIELDS)
     except ValueError:
         return jsonify(response_object), 404
+    except InvalidFields:
+        return jsonify(INVALID_FIELDS), 400
+    if is_conditional():
+        # revalidate from updated_at alone, without loading the row
+        updated_at = db.session.query(
+            User.updated_at).filter(User.id == user_id).scalar()
+        if updated_at is None:
+            return jsonify(response_object), 404
+        etag = make_etag('user', user_id, updated_at.isoformat(), fields)
+        if not_modified(etag, updated_at):
+            return not_modified_response(etag, updated_at)
+    # only the requested columns are selected
+    user = db.session.query(*user_columns(fields, 'updated_at')).filter(
+        User.id == user_id).first()
+    if not user:
+        return jsonify(response_object), 404
+    else:
+        response_object = {
+            'status': 'success',
+            'data': {field: getattr(user, field) for field in fields}
+        }
+        etag = make_etag('user', user_id, user.updated_at.isoformat(), fields)
+        return set_validators(
+            jsonify(response_object), etag, user.updated_at), 200
 
 
 @users_blueprint.route('/users', methods=['GET'])
 def get_all_users():
-    """Get all users"""
-    users = User.query.order_by(User.created_at.desc()).all()
+    """Get all users, newest first, one keyset page at a time"""
+    try:
+        fields = requested_fields(USER_FIELDS)
+    except InvalidFields:
+        return jsonify(INVALID_FIELDS), 400
+    if 'ids' in request.args:
+        return get_users_by_ids(fields)
+    if wants_stream():
+        return stream_all_users(fields)
+    # serialized pages are served from memory until the next user write
+    key = tuple(sorted(request.args.items(multi=True)))
+    generation = response_cache.generation
+    cached = response_cache.get(key)
+    if cached is not None:
+        body, etag, last_modified = cached
+        if not_modified(etag, last_modified):
+            return not_modified_response(etag, last_modified)
+        response = current_app.response_class(
+            body, mimetype='application/json')
+        return set_validators(response, etag, last_modified), 200
+    response_object = {
+        'status': 'fail',
+        'message': 'Invalid pagination parameters.'
+    }
+    try:
+        limit = int(request.args.get(
+            'limit', current_app.config.get('USERS_PER_PAGE')))
+        if limit < 1:
+            return jsonify(response_object), 400
+        limit = min(limit, current_app.config.get('USERS_MAX_PER_PAGE'))
+        # the keyset columns are always selected to build the next cursor,
+        # updated_at to build the validators
+        query = db.session.query(
+            *user_columns(fields, 'created_at', 'id', 'updated_at')
+        ).order_by(User.created_at.desc(), User.id.desc())
+        query = filter_active(query)
+        after = request.args.get('after')
+        if after:
+            created_at, user_id = decode_cursor(after)
+            query = query.filter(
+                tuple_(User.created_at, User.id) < tuple_(created_at, user_id))
+    except ValueError:
+        return jsonify(response_object), 400
+    # fetch one extra row to find out if there is a next page
+    users = query.limit(limit + 1).all()
+    # the page changes when one of its rows, or the row after it, is
+    # written, added or removed
+    last_modified = max((user.updated_at for user in users), default=None)
+    etag = make_etag(
+        'users', last_modified and last_modified.isoformat(),
+        [user.id for user in users], sorted(request.args.items()))
+    if not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = encode_cursor(users[-1].created_at, users[-1].id)
     users_list = []
     for user in users:
-        user_object = {
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'created_at': user.created_at
-        }
+        user_object = {field: getattr(user, field) for field in fields}
         users_list.append(user_object)
     response_object = {
         'status': 'success',
         'data': {
-            'users': users_list
+            'users': users_list,
+            'next_cursor': next_cursor
+        }
+    }
+    response = jsonify(response_object)
+    response_cache.set(
+        key, (response.get_data(), etag, last_modified),
+        generation=generation)
+    return set_validators(response, etag, last_modified), 200
+
+
+def get_users_by_ids(fields):
+    """Resolve a batch of user ids with a single IN query"""
+    response_object = {
+        'status': 'fail',
+        'message': 'Invalid ids.'
+    }
+    try:
+        ids = [int(user_id) for user_id in request.args['ids'].split(',')]
+    except ValueError:
+        return jsonify(response_object), 400
+    max_ids = current_app.config.get('USERS_BATCH_MAX_IDS')
+    if len(ids) > max_ids:
+        response_object['message'] = f'Too many ids (max {max_ids}).'
+        return jsonify(response_object), 400
+    try:
+        query = filter_active(db.session.query(
+            *user_columns(fields, 'id')).filter(User.id.in_(set(ids))))
+    except ValueError:
+        return jsonify(INVALID_ACTIVE), 400
+    found = {
+        user.id: {field: getattr(user, field) for field in fields}
+        for user in query
+    }
+    # results line up with the requested ids, misses (including users
+    # the active filter excludes) are null
+    response_object = {
+        'status': 'success',
+        'data': {
+            'users': [found.get(user_id) for user_id in ids],
+            'missing': [user_id for user_id in ids if user_id not in found]
         }
     }
     return jsonify(response_object), 200
+
+
+def requested_fields(default):
+    """Parses ?fields=a,b - :return: tuple of field names"""
+    fields = request.args.get('fields')
+    if fields is None:
+        return default
+    fields = tuple(dict.fromkeys(
+        field.strip() for field in fields.split(',') if field.strip()))
+    if not fields or any(field not in USER_FIELDS for field in fields):
+        raise InvalidFields()
+    return fields
+
+
+def user_columns(fields, *extra):
+    """User columns to select for the given fields and extra names"""
+    return [getattr(User, name) for name in dict.fromkeys(fields + extra)]
+
+
+def filter_active(query):
+    """Applies ?active= to a users query - :raises: ValueError"""
+    active = request.args.get('active')
+    if active is None:
+        return query
+    if active not in ('true', 'false'):
+        raise ValueError('active must be true or false')
+    # active=true reads the partial index of active users
+    return query.filter(User.active == (active == 'true'))
+
+
+def wants_stream():
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best == STREAM_MIMETYPE
+
+
+def stream_all_users(fields):
+    """Stream every user as newline-delimited JSON"""
+    batch_size = current_app.config.get('USERS_STREAM_BATCH_SIZE')
+    # plain column rows over a server-side cursor, so neither the driver
+    # nor the ORM buffers the whole table
+    try:
+        query = filter_active(db.session.query(*user_columns(fields)))
+    except ValueError:
+        return jsonify(INVALID_ACTIVE), 400
+    rows = query.order_by(
+        User.created_at.desc(), User.id.desc()
+    ).execution_options(stream_results=True).yield_per(batch_size)
+
+    def generate():
+        for row in rows:
+            yield json.dumps(row._asdict()) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=STREAM_MIMETYPE)
@@ -1,13 +1,23 @@
 # project/api/utils.py
 
 
+import base64
+import binascii
+import datetime
+import hashlib
+import json
+from collections import namedtuple
 from functools import wraps
 
-from flask import request, jsonify
+from flask import current_app, g, request, jsonify
 
+from project import db, principal_cache, revocation_list
 from project.api.models import User
 
 
+Principal = namedtuple('Principal', ['id', 'active', 'admin'])
+
+
 def authenticate(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -26,13 +36,109 @@ def authenticate(f):
         if isinstance(resp, str):
             response_object['message'] = resp
             return jsonify(response_object), code
-        user = User.query.filter_by(id=resp).first()
-        if not user or not user.active:
+        if revocation_list.is_revoked(User.token_digest(auth_token)):
+            response_object['message'] = 'Token revoked. Please log in again.'
+            return jsonify(response_object), code
+        principal = load_principal(resp)
+        if not principal or not principal.active:
             return jsonify(response_object), code
+        g.principal = principal
         return f(resp, *args, **kwargs)
     return decorated_function
 
 
 def is_admin(user_id):
-    user = User.query.filter_by(id=user_id).first()
-    return user.admin
+    # reuse the principal already loaded by authenticate for this request
+    principal = g.get('principal')
+    if principal is None or principal.id != user_id:
+        principal = load_principal(user_id)
+    return principal is not None and principal.admin
+
+
+def load_principal(user_id):
+    """Loads the (id, active, admin) of a user - :return: Principal|None"""
+    principal = principal_cache.get(user_id)
+    if principal is None:
+        # a row read before a concurrent invalidation is not cached
+        generation = principal_cache.generation
+        row = db.session.query(
+            User.id, User.active, User.admin).filter_by(id=user_id).first()
+        if row is None:
+            return None
+        principal = Principal(*row)
+        principal_cache.set(user_id, principal, generation=generation)
+    return principal
+
+
+def load_principals(user_ids):
+    """Loads many principals with at most one query - :return: dict"""
+    principals = {}
+    for user_id in set(user_ids):
+        principal = principal_cache.get(user_id)
+        if principal is not None:
+            principals[user_id] = principal
+    missing = set(user_ids) - set(principals)
+    if missing:
+        generation = principal_cache.generation
+        rows = db.session.query(User.id, User.active, User.admin).filter(
+            User.id.in_(missing))
+        for row in rows:
+            principals[row.id] = Principal(*row)
+            principal_cache.set(
+                row.id, principals[row.id], generation=generation)
+    return principals
+
+
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(created_at, user_id):
+    """Encodes a (created_at, id) keyset position as an opaque cursor"""
+    position = [created_at.strftime(CURSOR_DATE_FORMAT), user_id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decodes an opaque cursor - :return: (created_at, id) - :raises: ValueError"""
+    try:
+        created_at, user_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())
+        return (
+            datetime.datetime.strptime(created_at, CURSOR_DATE_FORMAT),
+            int(user_id)
+        )
+    except (binascii.Error, TypeError) as e:
+        raise ValueError('Invalid cursor.') from e
+
+
+def make_etag(*parts):
+    """Builds an entity tag from the values a representation depends on"""
+    return hashlib.md5(
+        '|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def is_conditional():
+    return bool(request.if_none_match) or \
+        request.if_modified_since is not None
+
+
+def not_modified(etag, last_modified):
+    """Checks If-None-Match / If-Modified-Since against a representation"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= \
+            request.if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def not_modified_response(etag, last_modified):
+    return set_validators(
+        current_app.response_class(status=304), etag, last_modified)
@@ -0,0 +1,167 @@
+# project/bench.py
+
+
+import datetime
+import math
+import platform
+import secrets
+import time
+from contextlib import contextmanager
+
+from flask import current_app, jsonify
+
+from project import config, db, hashing_pool, token_cache
+from project.api.models import User
+
+
+BENCH_PREFIX = 'bench_'
+
+
+class BenchRefused(Exception):
+    """Raised when the configured database may hold real accounts"""
+
+
+def percentile(timings, pct):
+    """Nearest-rank percentile of a sorted list"""
+    index = max(0, math.ceil(pct / 100 * len(timings)) - 1)
+    return timings[index]
+
+
+def measure(fn, iterations):
+    """Times fn - :return: p50/p99 in microseconds and ops per second"""
+    fn()  # warm up
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'p50_us': round(percentile(timings, 50) * 1e6, 2),
+        'p99_us': round(percentile(timings, 99) * 1e6, 2),
+        'ops_per_sec': round(iterations / sum(timings), 2)
+    }
+
+
+@contextmanager
+def rolled_back_session():
+    """Points db.session at a transaction that is never committed, so
+    seeded rows are invisible to other connections and vanish even if
+    the process is killed"""
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    session = db.create_scoped_session(
+        options=dict(bind=connection, binds={}))
+    saved, db.session = db.session, session
+    try:
+        yield
+    finally:
+        session.remove()
+        db.session = saved
+        transaction.rollback()
+        connection.close()
+
+
+def seed(size, prefix):
+    """Inserts size users sharing one throwaway password hash"""
+    password = hashing_pool.generate_password_hash(secrets.token_hex(), 4)
+    now = datetime.datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [{
+        'username': f'{prefix}{i}',
+        'email': f'{prefix}{i}@bench.local',
+        'password': password,
+        'active': True,
+        'admin': False,
+        'created_at': now - datetime.timedelta(seconds=i),
+        'updated_at': now
+    } for i in range(size)])
+
+
+def configured_costs():
+    """Every bcrypt cost set by a config class or the running app"""
+    costs = {current_app.config.get('BCRYPT_LOG_ROUNDS')}
+    for name in dir(config):
+        value = getattr(config, name)
+        if isinstance(value, type) and issubclass(value, config.BaseConfig):
+            costs.add(value.BCRYPT_LOG_ROUNDS)
+    return sorted(costs)
+
+
+def user_dicts(users):
+    return [{
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'created_at': user.created_at
+    } for user in users]
+
+
+def run(size, iterations, bcrypt_iterations, costs=None):
+    """Runs every microbenchmark against a seeded, rolled back dataset
+
+    :param costs: bcrypt costs to time, by default every configured one
+    """
+    if not current_app.config.get('BENCH_ENABLED'):
+        raise BenchRefused(
+            'Benchmarks only run against Development or Testing databases '
+            'or BENCH_DATABASE_URL.')
+    prefix = f'{BENCH_PREFIX}{secrets.token_hex(4)}_'
+    meta = {
+        'size': size,
+        'iterations': iterations,
+        'python': platform.python_version(),
+        'started_at': datetime.datetime.utcnow().isoformat()
+    }
+    with rolled_back_session():
+        seed(size, prefix)
+        return {
+            'meta': meta,
+            'results': run_benchmarks(
+                prefix, iterations, bcrypt_iterations,
+                costs or configured_costs())
+        }
+
+
+def run_benchmarks(prefix, iterations, bcrypt_iterations, costs):
+    results = {}
+    users = User.query.filter(User.username.startswith(prefix)).order_by(
+        User.created_at.desc(), User.id.desc()).all()
+    user = users[len(users) // 2]
+    token = user.encode_auth_token(user.id)
+
+    results['jwt_encode'] = measure(
+        lambda: user.encode_auth_token(user.id), iterations)
+
+    def decode_uncached():
+        token_cache.invalidate(User.token_digest(token))
+        User.decode_auth_token(token)
+
+    results['jwt_decode'] = measure(decode_uncached, iterations)
+    results['jwt_decode_cached'] = measure(
+        lambda: User.decode_auth_token(token), iterations)
+
+    for rounds in costs:
+        pw_hash = hashing_pool.generate_password_hash('bench', rounds)
+        results[f'bcrypt_hash_cost_{rounds}'] = measure(
+            lambda: hashing_pool.generate_password_hash('bench', rounds),
+            bcrypt_iterations)
+        results[f'bcrypt_check_cost_{rounds}'] = measure(
+            lambda: hashing_pool.check_password_hash(pw_hash, 'bench'),
+            bcrypt_iterations)
+
+    results['users_build_dicts'] = measure(
+        lambda: user_dicts(users), iterations)
+    with current_app.test_request_context():
+        users_list = user_dicts(users)
+        results['users_jsonify'] = measure(lambda: jsonify({
+            'status': 'success',
+            'data': {'users': users_list}
+        }), iterations)
+
+    results['authenticate_principal_query'] = measure(
+        lambda: db.session.query(User.id, User.active, User.admin).filter_by(
+            id=user.id).first(), iterations)
+    results['user_row_query'] = measure(
+        lambda: User.query.filter_by(id=user.id).first(), iterations)
+    return results
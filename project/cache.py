@@ -0,0 +1,102 @@
+# project/cache.py
+
+
+import threading
+import time
+from collections import OrderedDict
+
+from project.metrics import CACHE_HITS, CACHE_MISSES
+
+
+class TTLCache:
+    """Bounded, thread-safe LRU cache whose entries expire after a TTL
+
+    Configured like the other extensions: the instance is created at import
+    time and sized from ``<PREFIX>_SIZE`` / ``<PREFIX>_TTL`` in ``init_app``.
+    A size or TTL of 0 disables the cache.
+
+    ``generation`` is bumped by every invalidation; pass the value read
+    before computing an entry to ``set`` so that an entry computed from
+    data that has since been written is dropped instead of stored.
+
+    Lookups are also counted on ``/metrics``, labelled with the prefix
+    without ``_CACHE`` (``principal``, ``token``, ``response``).
+    """
+
+    def __init__(self, config_prefix, maxsize=0, ttl=0):
+        self.config_prefix = config_prefix
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        name = config_prefix.lower()
+        if name.endswith('_cache'):
+            name = name[:-len('_cache')]
+        self._hits_metric = CACHE_HITS.labels(name)
+        self._misses_metric = CACHE_MISSES.labels(name)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.maxsize = app.config.get(f'{self.config_prefix}_SIZE', 0)
+        self.ttl = app.config.get(f'{self.config_prefix}_TTL', 0)
+        self.clear()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                self._misses_metric.inc()
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                self._misses_metric.inc()
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            self._hits_metric.inc()
+            return value
+
+    def set(self, key, value, ttl=None, generation=None):
+        """Stores a value - :param ttl: overrides the default TTL (seconds)"""
+        if not self.enabled:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
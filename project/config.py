@@ -9,10 +9,74 @@ class BaseConfig:
     DEBUG = False
     TESTING = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # 'queue' or 'pgbouncer' (NullPool, for transaction pooling)
+    SQLALCHEMY_POOL_MODE = os.environ.get('SQLALCHEMY_POOL_MODE', 'queue')
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('SQLALCHEMY_POOL_SIZE', 5))
+    SQLALCHEMY_MAX_OVERFLOW = int(
+        os.environ.get('SQLALCHEMY_MAX_OVERFLOW', 10))
+    SQLALCHEMY_POOL_TIMEOUT = int(os.environ.get('SQLALCHEMY_POOL_TIMEOUT', 10))
+    SQLALCHEMY_POOL_RECYCLE = int(
+        os.environ.get('SQLALCHEMY_POOL_RECYCLE', 1800))
+    # a SELECT 1 on every checkout; pool_recycle already retires old
+    # connections, so only turn it on behind connection-dropping networks
+    SQLALCHEMY_POOL_PRE_PING = \
+        os.environ.get('SQLALCHEMY_POOL_PRE_PING') == 'true'
+    # comma-separated read replicas for GET requests, empty for none
+    SQLALCHEMY_REPLICA_URIS = [
+        uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if uri]
+    # a streaming replica that has replayed all it received counts as 0
+    # behind; a disconnected one by the age of its last replay
+    REPLICA_MAX_LAG_SECONDS = float(
+        os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+    REPLICA_LAG_CHECK_SECONDS = 1
+    REPLICA_STICKY_SECONDS = 10
     SECRET_KEY = os.environ.get('SECRET_KEY')
-    BCRYPT_LOG_ROUNDS = 13
+    # set by the gunicorn master when BCRYPT_TARGET_MS asks for calibration
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 13))
+    BCRYPT_TARGET_MS = float(os.environ.get('BCRYPT_TARGET_MS', 0))
+    BCRYPT_MIN_LOG_ROUNDS = 10
+    BCRYPT_MAX_LOG_ROUNDS = 16
+    BCRYPT_POOL_KIND = os.environ.get('BCRYPT_POOL_KIND', 'thread')
+    BCRYPT_POOL_SIZE = int(os.environ.get('BCRYPT_POOL_SIZE', 0))
+    BCRYPT_POOL_MAX_QUEUE = int(os.environ.get('BCRYPT_POOL_MAX_QUEUE', 16))
     TOKEN_EXPIRATION_DAYS = 30
     TOKEN_EXPIRATION_SECONDS = 0
+    # 'HS256' signs with SECRET_KEY, 'RS256' with the keys in JWT_KEYS_DIR
+    JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
+    JWT_KEYS_DIR = os.environ.get('JWT_KEYS_DIR')
+    JWT_ACTIVE_KID = os.environ.get('JWT_ACTIVE_KID')
+    JWKS_MAX_AGE = 3600
+    USERS_PER_PAGE = 100
+    USERS_MAX_PER_PAGE = 1000
+    USERS_STREAM_BATCH_SIZE = 1000
+    USERS_IMPORT_BATCH_SIZE = 1000
+    USERS_BATCH_MAX_IDS = 100
+    PRINCIPAL_CACHE_SIZE = 10000
+    PRINCIPAL_CACHE_TTL = 30
+    TOKEN_CACHE_SIZE = 50000
+    TOKEN_CACHE_TTL = 3600
+    INTROSPECT_MAX_TOKENS = 100
+    REVOCATION_FILTER_CAPACITY = 100000
+    REVOCATION_FILTER_ERROR_RATE = 0.001
+    REVOCATION_REFRESH_SECONDS = 5
+    REVOCATION_REBUILD_SECONDS = 3600
+    # writes invalidate the local worker at once; the TTL bounds how long
+    # other workers may serve a collection from before the write
+    RESPONSE_CACHE_SIZE = 256
+    RESPONSE_CACHE_TTL = 5
+    # manage.py bench seeds users, so only throwaway databases may run it
+    BENCH_ENABLED = False
+    # per worker: concurrent requests, and per client requests/second
+    ADMISSION_LIMITS = {
+        'auth.login_user': {'concurrency': 8, 'rate': 1, 'burst': 10},
+        'auth.register_user': {'concurrency': 4, 'rate': 0.2, 'burst': 5},
+        'users.add_user': {'concurrency': 4, 'rate': 5, 'burst': 20}
+    }
+    ADMISSION_CLIENT_HEADER = os.environ.get('ADMISSION_CLIENT_HEADER')
+    # proxies in front of the app that append to ADMISSION_CLIENT_HEADER
+    ADMISSION_TRUSTED_HOPS = int(os.environ.get('ADMISSION_TRUSTED_HOPS', 1))
+    ADMISSION_MAX_CLIENTS = 100000
 
 
 class DevelopmentConfig(BaseConfig):
@@ -20,6 +84,7 @@ class DevelopmentConfig(BaseConfig):
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
     BCRYPT_LOG_ROUNDS = 4
+    BENCH_ENABLED = True
 
 
 class TestingConfig(BaseConfig):
@@ -28,8 +93,14 @@ class TestingConfig(BaseConfig):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_TEST_URL')
     BCRYPT_LOG_ROUNDS = 4
+    BCRYPT_POOL_SIZE = 2
+    SQLALCHEMY_POOL_SIZE = 2
+    SQLALCHEMY_MAX_OVERFLOW = 2
+    SQLALCHEMY_REPLICA_URIS = []
     TOKEN_EXPIRATION_DAYS = 0
     TOKEN_EXPIRATION_SECONDS = 3
+    ADMISSION_LIMITS = {}
+    BENCH_ENABLED = True
 
 
 class StagingConfig(BaseConfig):
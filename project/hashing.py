@@ -0,0 +1,183 @@
+# project/hashing.py
+
+
+import itertools
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import bcrypt
+
+from project.metrics import (
+    BCRYPT_IN_FLIGHT, BCRYPT_LATENCY, BCRYPT_QUEUED, BCRYPT_REJECTIONS)
+
+
+class HashingPoolFull(Exception):
+    """Raised when the password hashing queue is at capacity"""
+
+
+def _generate_password_hash(password, rounds):
+    return bcrypt.hashpw(
+        password.encode('utf-8'), bcrypt.gensalt(rounds)).decode()
+
+
+def _check_password_hash(pw_hash, password):
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+def generate_password_hashes(executor, passwords, rounds):
+    """Hashes many passwords across the workers of an executor"""
+    if not all(passwords):
+        raise ValueError('Password must be non-empty.')
+    chunksize = max(1, len(passwords) // (4 * (os.cpu_count() or 1)))
+    return list(executor.map(
+        _generate_password_hash, passwords, itertools.repeat(rounds),
+        chunksize=chunksize))
+
+
+def green_threads():
+    """Returns True when threading is monkey patched by gevent"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def hash_cost(pw_hash):
+    """Returns the bcrypt cost of a hash - :return: integer|None"""
+    try:
+        return int(pw_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def calibrate_log_rounds(target_ms, min_rounds=4, max_rounds=16, samples=5):
+    """Picks the highest bcrypt cost that hashes within target_ms here,
+    judged on the median of several hashes per cost"""
+    rounds = min_rounds
+    for candidate in range(min_rounds, max_rounds + 1):
+        timings = []
+        for _ in range(samples):
+            start = time.monotonic()
+            _generate_password_hash('calibration', candidate)
+            timings.append(time.monotonic() - start)
+        elapsed_ms = statistics.median(timings) * 1000
+        if elapsed_ms > target_ms and candidate > min_rounds:
+            break
+        rounds = candidate
+        # every extra round doubles the cost
+        if elapsed_ms * 2 > target_ms:
+            break
+    return rounds
+
+
+class HashingPool:
+    """Runs bcrypt on a bounded worker pool instead of the request worker
+
+    ``BCRYPT_POOL_KIND`` picks a ``thread`` pool (bcrypt releases the GIL)
+    or a ``process`` pool, ``BCRYPT_POOL_SIZE`` its number of workers and
+    ``BCRYPT_POOL_MAX_QUEUE`` how many calls may wait for a free worker
+    before new ones are rejected with ``HashingPoolFull``. Under a gevent
+    worker the thread pool is gevent's pool of native threads, so hashing
+    never runs on the event loop.
+
+    The cost itself is ``BCRYPT_LOG_ROUNDS``. ``manage.py calibrate_bcrypt``
+    prints the highest cost that fits ``BCRYPT_TARGET_MS`` on the host; the
+    gunicorn master runs it once at boot and hands the result to every
+    worker, so all workers agree on the cost.
+    """
+
+    def __init__(self):
+        self.kind = 'thread'
+        self.size = 1
+        self.max_queue = 0
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            ['submitted', 'rejected', 'completed', 'in_flight'], 0)
+        self._stats['seconds'] = 0.0
+
+    def init_app(self, app):
+        self.kind = app.config.get('BCRYPT_POOL_KIND')
+        self.size = app.config.get('BCRYPT_POOL_SIZE') or os.cpu_count()
+        self.max_queue = app.config.get('BCRYPT_POOL_MAX_QUEUE')
+        self.shutdown()
+
+    def generate_password_hash(self, password, rounds):
+        if not password:
+            raise ValueError('Password must be non-empty.')
+        return self._run('hash', _generate_password_hash, password, rounds)
+
+    def check_password_hash(self, pw_hash, password):
+        if not password:
+            return False
+        return self._run('check', _check_password_hash, pw_hash, password)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(kind=self.kind, size=self.size, max_queue=self.max_queue)
+        return stats
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+            self._pid = None
+
+    def _get_executor(self):
+        # executors do not survive a fork, so each gunicorn worker
+        # lazily builds its own
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                if self.kind == 'process':
+                    self._executor = ProcessPoolExecutor(self.size)
+                elif green_threads():
+                    from gevent.threadpool import ThreadPoolExecutor \
+                        as NativeThreadPoolExecutor
+                    self._executor = NativeThreadPoolExecutor(self.size)
+                else:
+                    self._executor = ThreadPoolExecutor(self.size)
+                self._slots = threading.BoundedSemaphore(
+                    self.size + self.max_queue)
+                self._pid = os.getpid()
+            return self._executor, self._slots
+
+    def _record(self, operation, start):
+        elapsed = time.monotonic() - start
+        BCRYPT_LATENCY.labels(operation).observe(elapsed)
+        with self._lock:
+            self._stats['in_flight'] -= 1
+            self._stats['completed'] += 1
+            self._stats['seconds'] += elapsed
+            self._export_depth()
+
+    def _export_depth(self):
+        # called with the lock held
+        in_flight = self._stats['in_flight']
+        BCRYPT_IN_FLIGHT.set(in_flight)
+        BCRYPT_QUEUED.set(max(0, in_flight - self.size))
+
+    def _run(self, operation, fn, *args):
+        executor, slots = self._get_executor()
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            BCRYPT_REJECTIONS.labels(operation).inc()
+            raise HashingPoolFull('Password hashing queue is full.')
+        start = time.monotonic()
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._stats['in_flight'] += 1
+            self._export_depth()
+        try:
+            return executor.submit(fn, *args).result()
+        finally:
+            slots.release()
+            self._record(operation, start)
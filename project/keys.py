@@ -0,0 +1,110 @@
+# project/keys.py
+
+
+import base64
+import os
+
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from flask import current_app
+
+
+def b64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def generate_private_key_pem():
+    """Generates a new 2048-bit RSA signing key - :return: PEM bytes"""
+    key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend())
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption())
+
+
+class KeyRing:
+    """Keys used to sign and verify auth tokens
+
+    With ``JWT_ALGORITHM = 'HS256'`` tokens are signed with ``SECRET_KEY``.
+    With ``RS256`` every ``<kid>.pem`` private key in ``JWT_KEYS_DIR`` is
+    loaded: ``JWT_ACTIVE_KID`` (by default the last kid in sort order)
+    signs new tokens, and all of them verify tokens and are published as
+    a JWKS so other services can verify tokens locally. To rotate, add a
+    new key and make it active; drop the old one once its tokens expire.
+    """
+
+    def __init__(self):
+        self.algorithm = 'HS256'
+        self.active_kid = None
+        self.keys = {}
+
+    def init_app(self, app):
+        self.algorithm = app.config.get('JWT_ALGORITHM')
+        self.keys = {}
+        self.active_kid = None
+        keys_dir = app.config.get('JWT_KEYS_DIR')
+        if self.algorithm != 'HS256' and keys_dir:
+            for filename in sorted(os.listdir(keys_dir)):
+                kid, ext = os.path.splitext(filename)
+                if ext == '.pem':
+                    with open(os.path.join(keys_dir, filename), 'rb') as f:
+                        self.add_key(kid, f.read())
+        self.active_kid = app.config.get('JWT_ACTIVE_KID') or self.active_kid
+        if self.algorithm != 'HS256' and self.active_kid not in self.keys:
+            raise RuntimeError(
+                f'No signing key for {self.algorithm} in JWT_KEYS_DIR.')
+
+    def add_key(self, kid, pem):
+        self.keys[kid] = serialization.load_pem_private_key(
+            pem, password=None, backend=default_backend())
+        self.active_kid = max(self.keys)
+
+    def encode(self, payload):
+        if self.algorithm == 'HS256':
+            return jwt.encode(
+                payload,
+                current_app.config.get('SECRET_KEY'),
+                algorithm='HS256'
+            )
+        return jwt.encode(
+            payload,
+            self.keys[self.active_kid],
+            algorithm=self.algorithm,
+            headers={'kid': self.active_kid}
+        )
+
+    def decode(self, auth_token):
+        """Verifies a token - :return: payload - :raises: InvalidTokenError"""
+        if self.algorithm == 'HS256':
+            return jwt.decode(
+                auth_token,
+                current_app.config.get('SECRET_KEY'),
+                algorithms=['HS256']
+            )
+        kid = jwt.get_unverified_header(auth_token).get('kid')
+        if kid not in self.keys:
+            raise jwt.InvalidTokenError('Unknown key id.')
+        return jwt.decode(
+            auth_token,
+            self.keys[kid].public_key(),
+            algorithms=[self.algorithm]
+        )
+
+    def jwks(self):
+        """Public keys as a JSON Web Key Set"""
+        keys = []
+        for kid, key in sorted(self.keys.items()):
+            numbers = key.public_key().public_numbers()
+            keys.append({
+                'kty': 'RSA',
+                'use': 'sig',
+                'alg': self.algorithm,
+                'kid': kid,
+                'n': b64url_uint(numbers.n),
+                'e': b64url_uint(numbers.e)
+            })
+        return {'keys': keys}
@@ -0,0 +1,107 @@
+# project/metrics.py
+
+
+import os
+import time
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+    Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+REQUEST_LATENCY = Histogram(
+    'users_request_duration_seconds', 'HTTP request latency.',
+    ['blueprint', 'endpoint', 'method', 'status'])
+REQUEST_SQL_STATEMENTS = Histogram(
+    'users_request_sql_statements', 'SQL statements run per HTTP request.',
+    ['blueprint', 'endpoint'], buckets=(0, 1, 2, 3, 4, 5, 8, 13, 21, 34))
+SQL_LATENCY = Histogram(
+    'users_sql_duration_seconds', 'SQL statement latency.', ['statement'])
+BCRYPT_LATENCY = Histogram(
+    'users_bcrypt_duration_seconds', 'bcrypt operation latency.',
+    ['operation'])
+BCRYPT_IN_FLIGHT = Gauge(
+    'users_bcrypt_in_flight', 'bcrypt calls running or queued.',
+    multiprocess_mode='livesum')
+BCRYPT_QUEUED = Gauge(
+    'users_bcrypt_queued', 'bcrypt calls waiting for a free pool worker.',
+    multiprocess_mode='livesum')
+BCRYPT_REJECTIONS = Counter(
+    'users_bcrypt_rejections_total',
+    'bcrypt calls rejected because the queue was full.', ['operation'])
+CACHE_HITS = Counter(
+    'users_cache_hits_total', 'Cache lookups that found an entry.',
+    ['cache'])
+CACHE_MISSES = Counter(
+    'users_cache_misses_total', 'Cache lookups that found nothing.',
+    ['cache'])
+JWT_LATENCY = Histogram(
+    'users_jwt_duration_seconds', 'JWT operation latency.', ['operation'])
+ADMISSION_REJECTIONS = Counter(
+    'users_admission_rejections_total',
+    'Requests rejected by admission control.', ['endpoint', 'reason'])
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    # the start time lives and dies with the statement, even a failed one;
+    # only the dialect's own setup queries run without a context
+    if context is not None:
+        context._metrics_start = time.monotonic()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    if context is None:
+        return
+    elapsed = time.monotonic() - context._metrics_start
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement else ''
+    SQL_LATENCY.labels(verb).observe(elapsed)
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+
+
+class Metrics:
+    """Prometheus metrics for the service, served at ``/metrics``
+
+    Under gunicorn, set the ``prometheus_multiproc_dir`` environment
+    variable to an empty directory before the app is imported; every
+    worker then writes its samples there and ``/metrics`` aggregates them.
+    """
+
+    def init_app(self, app):
+        app.before_request(self.start_timer)
+        app.after_request(self.record_request)
+        app.add_url_rule('/metrics', 'metrics', self.expose)
+        if not event.contains(
+                Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    def start_timer(self):
+        g.request_start = time.monotonic()
+        g.sql_statements = 0
+
+    def record_request(self, response):
+        if 'request_start' not in g:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        blueprint = request.blueprint or ''
+        REQUEST_LATENCY.labels(
+            blueprint, endpoint, request.method, response.status_code
+        ).observe(time.monotonic() - g.request_start)
+        REQUEST_SQL_STATEMENTS.labels(blueprint, endpoint).observe(
+            g.sql_statements)
+        return response
+
+    def expose(self):
+        if 'prometheus_multiproc_dir' in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(
+            generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,290 @@
+# project/pool.py
+
+
+import os
+import random
+import threading
+import time
+
+import sqlalchemy
+from flask import request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.sql import Select
+
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PRIMARY_COOKIE = 'read_primary'
+# seconds behind the primary: 0 when the server is not a standby, or
+# when its WAL receiver is streaming and has replayed everything it
+# received, so a quiet primary does not make an up to date replica look
+# stale; otherwise the age of the last replay, which keeps growing on a
+# standby cut off from its primary (NULL before anything was replayed)
+REPLICA_LAG_SQL = (
+    'SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 '
+    '{caught_up}'
+    'ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END')
+# pg_stat_wal_receiver is PostgreSQL 9.6+; its status reads NULL without
+# pg_read_all_stats, which only disables the shortcut
+REPLICA_CAUGHT_UP_SQL = (
+    'WHEN pg_last_{wal}_receive_{lsn}() = pg_last_{wal}_replay_{lsn}() '
+    'AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver '
+    "WHERE status = 'streaming') THEN 0 ")
+
+
+def replica_lag_sql(server_version_info):
+    """The lag query for a server version (the functions were renamed
+    in PostgreSQL 10)"""
+    version = tuple(server_version_info or ())
+    if version >= (10,):
+        caught_up = REPLICA_CAUGHT_UP_SQL.format(wal='wal', lsn='lsn')
+    elif version >= (9, 6):
+        caught_up = REPLICA_CAUGHT_UP_SQL.format(wal='xlog', lsn='location')
+    else:
+        caught_up = ''
+    return sqlalchemy.text(REPLICA_LAG_SQL.format(caught_up=caught_up))
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Pessimistic disconnect handling: test each connection on checkout"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # the pool discards this connection and retries with a fresh one
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = time.monotonic() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                # anything under a millisecond never waited on the queue
+                if elapsed >= 0.001:
+                    self.waits += 1
+                self.wait_seconds += elapsed
+                self.max_wait_seconds = max(self.max_wait_seconds, elapsed)
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool; keep the counters running
+        pool = super().recreate()
+        pool.checkouts = self.checkouts
+        pool.waits = self.waits
+        pool.wait_seconds = self.wait_seconds
+        pool.max_wait_seconds = self.max_wait_seconds
+        return pool
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'pid': os.getpid(),
+                'size': self.size(),
+                'checked_in': self.checkedin(),
+                'checked_out': self.checkedout(),
+                'overflow': max(self.overflow(), 0),
+                'max_overflow': self._max_overflow,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_ms_total': round(self.wait_seconds * 1000, 3),
+                'wait_ms_max': round(self.max_wait_seconds * 1000, 3)
+            }
+
+
+class ReplicaSet:
+    """Read replica engines, each usable while its lag is under max_lag"""
+
+    def __init__(self, engines, max_lag, check_seconds):
+        self.engines = engines
+        self.max_lag = max_lag
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._lags = {}
+
+    def choose(self):
+        """Picks a replica that is not lagging - :return: Engine|None"""
+        engines = list(self.engines)
+        random.shuffle(engines)
+        for engine in engines:
+            lag = self.lag(engine)
+            if lag is not None and lag <= self.max_lag:
+                return engine
+        return None
+
+    def lag(self, engine):
+        """Replication lag in seconds, re-measured every check_seconds"""
+        now = time.monotonic()
+        with self._lock:
+            checked_at, lag = self._lags.get(engine, (None, None))
+            if checked_at is not None and \
+                    now - checked_at < self.check_seconds:
+                return lag
+            # claim the check so concurrent requests keep the old value
+            self._lags[engine] = (now, lag)
+        try:
+            with engine.connect() as connection:
+                lag = connection.execute(replica_lag_sql(
+                    connection.dialect.server_version_info)).scalar()
+            lag = None if lag is None else float(lag)
+        except exc.DBAPIError:
+            # unreachable replicas are skipped until the next check
+            lag = None
+        with self._lock:
+            self._lags[engine] = (now, lag)
+        return lag
+
+    def stats(self):
+        with self._lock:
+            return [{
+                'host': engine.url.host,
+                'database': engine.url.database,
+                'lag_seconds': self._lags.get(engine, (None, None))[1]
+            } for engine in self.engines]
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the reads of read-only requests to a replica
+
+    Only plain SELECTs are routed, and only while ``info['replica']`` is
+    set and the session has not written; anything else marks the session
+    as having written. Writes, flushes and locking reads go to the
+    primary, as does everything on a session bound explicitly to another
+    engine or connection.
+    """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.routable = self.bind is db.engine
+
+    def get_bind(self, mapper=None, clause=None):
+        reading = isinstance(clause, Select) and not self._flushing and \
+            clause._for_update_arg is None
+        if not reading:
+            self.info['wrote'] = True
+        elif self.routable and not self.info.get('wrote'):
+            replica = self.info.get('replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension with configurable, instrumented pooling
+
+    ``SQLALCHEMY_POOL_MODE`` is ``queue`` (an ``InstrumentedQueuePool``
+    sized by the usual ``SQLALCHEMY_POOL_*`` settings) or ``pgbouncer``,
+    which uses ``NullPool`` and leaves pooling to a transaction-mode
+    PgBouncer in front of Postgres. ``SQLALCHEMY_POOL_PRE_PING`` tests each
+    pooled connection on checkout; ``NullPool`` connections are always
+    fresh and never tested.
+
+    With ``SQLALCHEMY_REPLICA_URIS`` set, the reads of GET requests go to
+    a replica whose lag is within ``REPLICA_MAX_LAG_SECONDS``, or to the
+    primary when none is. A request that writes stays on the primary for
+    the rest of the request, and sets a cookie that keeps the client on
+    the primary for ``REPLICA_STICKY_SECONDS`` so it reads its own writes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._replicas = None
+        self._replica_uris = None
+        self._replicas_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        super().init_app(app)
+        app.before_request(self.route_request)
+        app.after_request(self.stick_to_primary)
+        app.teardown_request(self.end_routing)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def replicas(self, app):
+        """This worker's replica engines, created on first use"""
+        uris = app.config.get('SQLALCHEMY_REPLICA_URIS')
+        if not uris:
+            return None
+        with self._replicas_lock:
+            if self._replica_uris != uris:
+                self._replica_uris = list(uris)
+                self._replicas = ReplicaSet(
+                    [self.create_replica_engine(app, uri) for uri in uris],
+                    app.config.get('REPLICA_MAX_LAG_SECONDS'),
+                    app.config.get('REPLICA_LAG_CHECK_SECONDS'))
+            return self._replicas
+
+    def create_replica_engine(self, app, uri):
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, info, options)
+        return sqlalchemy.create_engine(info, **options)
+
+    def route_request(self):
+        session = self.session()
+        session.info['wrote'] = False
+        session.info['replica'] = None
+        if request.method not in READ_METHODS or \
+                request.cookies.get(PRIMARY_COOKIE):
+            return
+        replicas = self.replicas(self.get_app())
+        if replicas is not None:
+            session.info['replica'] = replicas.choose()
+
+    def stick_to_primary(self, response):
+        app = self.get_app()
+        if self.session().info.get('wrote') and \
+                app.config.get('SQLALCHEMY_REPLICA_URIS'):
+            response.set_cookie(
+                PRIMARY_COOKIE, '1',
+                max_age=app.config.get('REPLICA_STICKY_SECONDS'),
+                httponly=True)
+        return response
+
+    def end_routing(self, exc=None):
+        info = self.session().info
+        info.pop('replica', None)
+        info.pop('wrote', None)
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        if info.drivername.startswith('sqlite'):
+            return
+        if app.config.get('SQLALCHEMY_POOL_MODE') == 'pgbouncer':
+            for key in ('pool_size', 'pool_timeout', 'pool_recycle',
+                        'max_overflow'):
+                options.pop(key, None)
+            options['poolclass'] = NullPool
+            return
+        options['poolclass'] = InstrumentedQueuePool
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+            options['pool_events'] = [(ping_connection, 'checkout')]
+
+    def pool_stats(self):
+        pool = self.engine.pool
+        if isinstance(pool, InstrumentedQueuePool):
+            stats = pool.stats()
+        else:
+            stats = {'pid': os.getpid(), 'pool': type(pool).__name__}
+        if self._replicas is not None:
+            stats['replicas'] = self._replicas.stats()
+        return stats
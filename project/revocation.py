@@ -0,0 +1,135 @@
+# project/revocation.py
+
+
+import datetime
+import math
+import threading
+import time
+
+from sqlalchemy.dialects.postgresql import insert
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over SHA-256 digests"""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, digest):
+        # double hashing over two independent slices of the digest
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, digest):
+        for position in self._positions(digest):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, digest):
+        return all(self.bits[position // 8] & (1 << (position % 8))
+                   for position in self._positions(digest))
+
+
+class RevocationList:
+    """Revoked tokens, stored in postgres behind a per-worker Bloom filter
+
+    Logout writes the token digest to ``revoked_tokens`` until the token's
+    expiry. Each worker keeps a Bloom filter of the revoked digests,
+    topped up every ``REVOCATION_REFRESH_SECONDS`` with rows revoked since
+    the last refresh and rebuilt every ``REVOCATION_REBUILD_SECONDS`` to
+    shed expired ones. A digest the filter has never seen is not revoked
+    and costs no query; only probable hits are checked in the database.
+    """
+
+    def __init__(self):
+        self.capacity = 100000
+        self.error_rate = 0.001
+        self.refresh_seconds = 5
+        self.rebuild_seconds = 3600
+        self._lock = threading.Lock()
+        self._filter = None
+        self._rebuilt_at = None
+        self._refreshed_at = None
+        self._refreshed_since = None
+
+    def init_app(self, app):
+        self.capacity = app.config.get('REVOCATION_FILTER_CAPACITY')
+        self.error_rate = app.config.get('REVOCATION_FILTER_ERROR_RATE')
+        self.refresh_seconds = app.config.get('REVOCATION_REFRESH_SECONDS')
+        self.rebuild_seconds = app.config.get('REVOCATION_REBUILD_SECONDS')
+        with self._lock:
+            self._rebuilt_at = None
+
+    def clear(self):
+        """Forgets every revocation and treats the empty list as current"""
+        with self._lock:
+            self._filter = BloomFilter(self.capacity, self.error_rate)
+            self._rebuilt_at = self._refreshed_at = time.monotonic()
+            self._refreshed_since = datetime.datetime.utcnow()
+
+    def revoke(self, digest, expires_at):
+        from project import db
+        from project.api.models import RevokedToken
+        db.session.execute(insert(RevokedToken.__table__).values(
+            digest=digest.hex(),
+            revoked_at=datetime.datetime.utcnow(),
+            expires_at=expires_at
+        ).on_conflict_do_nothing())
+        db.session.commit()
+        self._refresh()
+        with self._lock:
+            self._filter.add(digest)
+
+    def is_revoked(self, digest):
+        return digest in self.revoked([digest])
+
+    def revoked(self, digests):
+        """Returns the revoked subset of digests"""
+        from project import db
+        from project.api.models import RevokedToken
+        self._refresh()
+        with self._lock:
+            candidates = {digest for digest in digests
+                          if digest in self._filter}
+        if not candidates:
+            return set()
+        rows = db.session.query(RevokedToken.digest).filter(
+            RevokedToken.digest.in_([digest.hex() for digest in candidates]),
+            RevokedToken.expires_at > datetime.datetime.utcnow())
+        return {bytes.fromhex(row.digest) for row in rows}
+
+    def _refresh(self):
+        from project import db
+        from project.api.models import RevokedToken
+        now = time.monotonic()
+        with self._lock:
+            rebuild = self._rebuilt_at is None or \
+                now - self._rebuilt_at > self.rebuild_seconds
+            if not rebuild and \
+                    now - self._refreshed_at <= self.refresh_seconds:
+                return
+            since = None if rebuild else self._refreshed_since
+            # claim this refresh so other threads keep using the filter
+            # they have; only the very first build makes everyone wait
+            self._refreshed_at = now
+            if rebuild and self._filter is not None:
+                self._rebuilt_at = now
+        started = datetime.datetime.utcnow()
+        query = db.session.query(RevokedToken.digest).filter(
+            RevokedToken.expires_at > started)
+        if since is not None:
+            # overlap the window so rows committed late are not missed
+            query = query.filter(
+                RevokedToken.revoked_at > since - datetime.timedelta(
+                    seconds=60))
+        digests = [bytes.fromhex(row.digest) for row in query]
+        with self._lock:
+            if rebuild:
+                self._filter = BloomFilter(self.capacity, self.error_rate)
+                self._rebuilt_at = now
+            for digest in digests:
+                self._filter.add(digest)
+            self._refreshed_since = started
@@ -1,22 +1,102 @@
 # project/tests/base.py
 
 
+from contextlib import contextmanager
+
+from flask import _app_ctx_stack
 from flask_testing import TestCase
+from sqlalchemy import event, orm
 
-from project import create_app, db
+from project import (
+    admission, create_app, db, key_ring, principal_cache, response_cache,
+    revocation_list, token_cache)
+from project.tests.utils import count_queries
 
 app = create_app()
 
 
+def restart_savepoint(session, transaction):
+    # every commit or rollback in the code under test ends the savepoint;
+    # open the next one so the test's outer transaction stays untouched
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
 class BaseTestCase(TestCase):
+    """Runs each test in a transaction that is rolled back afterwards
+
+    The schema is created once per run. ``db.session`` is swapped for a
+    session bound to a connection holding an outer transaction, and each
+    session begins in a savepoint, so the ``commit()`` and ``rollback()``
+    calls of the endpoints only ever end savepoints. Tests whose data must
+    be visible on other connections set ``transactional = False`` and
+    have their tables truncated instead.
+    """
+    transactional = True
+    schema_created = False
+
     def create_app(self):
         app.config.from_object('project.config.TestingConfig')
         return app
 
     def setUp(self):
-        db.create_all()
-        db.session.commit()
+        key_ring.init_app(self.app)
+        admission.configure(self.app.config)
+        principal_cache.clear()
+        token_cache.clear()
+        response_cache.clear()
+        revocation_list.clear()
+        if not BaseTestCase.schema_created:
+            db.drop_all()
+            db.create_all()
+            db.session.commit()
+            BaseTestCase.schema_created = True
+        if self.transactional:
+            self.begin_transaction()
 
     def tearDown(self):
         db.session.remove()
-        db.drop_all()
+        if self.transactional:
+            self.rollback_transaction()
+        else:
+            self.truncate_tables()
+
+    def begin_transaction(self):
+        db.session.remove()
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        factory = db.create_session(
+            dict(bind=self.connection, binds={}, query_cls=db.Query))
+        event.listen(factory, 'after_transaction_end', restart_savepoint)
+
+        def make_session():
+            session = factory()
+            session.begin_nested()
+            return session
+
+        self.db_session = db.session
+        db.session = orm.scoped_session(
+            make_session, scopefunc=_app_ctx_stack.__ident_func__)
+
+    def rollback_transaction(self):
+        db.session = self.db_session
+        self.transaction.rollback()
+        self.connection.close()
+
+    def truncate_tables(self):
+        tables = ', '.join(
+            table.name for table in db.metadata.sorted_tables)
+        db.session.execute(f'TRUNCATE {tables} RESTART IDENTITY CASCADE')
+        db.session.commit()
+        db.session.remove()
+
+    @contextmanager
+    def assertMaxQueries(self, n):
+        """Fails if the block runs more than n SQL statements"""
+        with count_queries() as statements:
+            yield statements
+        self.assertLessEqual(
+            len(statements), n,
+            f'{len(statements)} queries run, budget is {n}:\n' +
+            '\n'.join(statements))
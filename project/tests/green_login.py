@@ -0,0 +1,77 @@
+# project/tests/green_login.py
+"""Serves the app the way a gevent worker does and checks that reads are
+answered while a login waits on bcrypt
+
+Run as ``python -m project.tests.green_login <user id> <email> <password>``
+in a fresh interpreter: monkey patching has to happen before anything else
+is imported, which the test process itself cannot do. Exits non-zero with
+the reason on stderr when the read was held up by the login.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg  # noqa: E402
+patch_psycopg()
+
+import json  # noqa: E402
+import sys  # noqa: E402
+import urllib.request  # noqa: E402
+
+import bcrypt  # noqa: E402
+import gevent  # noqa: E402
+from gevent.pywsgi import WSGIServer  # noqa: E402
+
+from project import create_app  # noqa: E402
+
+# the hashing runs on a native thread, which must block for real
+release = monkey.get_original('_thread', 'allocate_lock')()
+hashing = []
+
+
+def slow_checkpw(password, hashed_password, checkpw=bcrypt.checkpw):
+    hashing.append(True)
+    release.acquire(timeout=10)
+    return checkpw(password, hashed_password)
+
+
+def request(url, data=None):
+    if data is not None:
+        data = urllib.request.Request(
+            url, data=json.dumps(data).encode(),
+            headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(data or url, timeout=10) as response:
+        return response.status
+
+
+def main(user_id, email, password):
+    release.acquire()
+    bcrypt.checkpw = slow_checkpw
+    server = WSGIServer(('127.0.0.1', 0), create_app(), log=None)
+    server.start()
+    base = f'http://127.0.0.1:{server.server_port}'
+    try:
+        login = gevent.spawn(
+            request, f'{base}/auth/login',
+            dict(email=email, password=password))
+        with gevent.Timeout(10, False):
+            while not hashing:
+                gevent.sleep(0.01)
+        if not hashing:
+            return 'login never reached bcrypt'
+        # the login greenlet is parked on the hashing pool
+        for _ in range(3):
+            if request(f'{base}/users/{user_id}') != 200:
+                return 'read failed'
+            if login.ready():
+                return 'login finished before the read'
+        release.release()
+        if login.get(timeout=10) != 200:
+            return 'login failed'
+    finally:
+        server.stop()
+    return None
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
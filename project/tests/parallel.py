@@ -0,0 +1,89 @@
+# project/tests/parallel.py
+
+
+import os
+import subprocess
+import tempfile
+import unittest
+from collections import Counter
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+
+def iter_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from iter_tests(test)
+        else:
+            yield test
+
+
+def split_modules(suite, workers):
+    """Spreads test modules over workers, biggest first, keeping the
+    number of tests per worker even - :return: list of module name lists"""
+    sizes = Counter(type(test).__module__ for test in iter_tests(suite))
+    shards = [[] for _ in range(min(workers, len(sizes)))]
+    loads = [0] * len(shards)
+    for module, size in sorted(sizes.items(), key=lambda item: -item[1]):
+        index = loads.index(min(loads))
+        shards[index].append(module)
+        loads[index] += size
+    return shards
+
+
+def shard_url(url, n):
+    """The database of worker n, named after the base test database"""
+    url = make_url(url)
+    url.database = f'{url.database}_{n}'
+    return str(url)
+
+
+def execute_autocommit(base_url, statements):
+    # CREATE/DROP DATABASE cannot run inside a transaction
+    engine = create_engine(
+        base_url, isolation_level='AUTOCOMMIT', poolclass=NullPool)
+    try:
+        with engine.connect() as connection:
+            for statement in statements:
+                connection.execute(statement)
+    finally:
+        engine.dispose()
+
+
+def create_databases(base_url, urls):
+    statements = []
+    for url in urls:
+        name = make_url(url).database
+        statements.append(f'DROP DATABASE IF EXISTS "{name}"')
+        statements.append(f'CREATE DATABASE "{name}"')
+    execute_autocommit(base_url, statements)
+
+
+def drop_databases(base_url, urls):
+    execute_autocommit(base_url, [
+        f'DROP DATABASE IF EXISTS "{make_url(url).database}"'
+        for url in urls])
+
+
+def run_shards(command, shards, urls):
+    """Runs command + modules for every shard at once, each against its
+    own database, then prints their output in order - :return: boolean"""
+    processes = []
+    for n, (modules, url) in enumerate(zip(shards, urls), 1):
+        output = tempfile.TemporaryFile()
+        env = dict(os.environ, DATABASE_TEST_URL=url)
+        process = subprocess.Popen(
+            command + modules, env=env, stdout=output,
+            stderr=subprocess.STDOUT)
+        processes.append((n, modules, process, output))
+    success = True
+    for n, modules, process, output in processes:
+        returncode = process.wait()
+        output.seek(0)
+        print(f'==> worker {n}: {", ".join(modules)}')
+        print(output.read().decode(), flush=True)
+        output.close()
+        success = success and returncode == 0
+    return success
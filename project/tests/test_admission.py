@@ -0,0 +1,110 @@
+# project/tests/test_admission.py
+
+
+import json
+
+from project import admission
+from project.tests.base import BaseTestCase
+
+
+def login(client, remote_addr='10.0.0.1'):
+    return client.post(
+        '/auth/login',
+        data=json.dumps(dict(email='joe@gmail.com', password='123456')),
+        content_type='application/json',
+        environ_base={'REMOTE_ADDR': remote_addr}
+    )
+
+
+class TestAdmission(BaseTestCase):
+
+    def limit(self, **limit):
+        self.app.config['ADMISSION_LIMITS'] = {'auth.login_user': limit}
+        admission.configure(self.app.config)
+
+    def test_rate_limit(self):
+        """Ensure a client over its rate gets a 429 with Retry-After."""
+        self.limit(rate=0.5, burst=2)
+        with self.client:
+            self.assertEqual(login(self.client).status_code, 404)
+            self.assertEqual(login(self.client).status_code, 404)
+            response = login(self.client)
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(data['status'], 'error')
+            self.assertEqual(
+                data['message'], 'Too many requests. Please try again later.')
+            self.assertEqual(response.headers['Retry-After'], '2')
+            # other clients have their own bucket
+            self.assertEqual(login(self.client, '10.0.0.2').status_code, 404)
+            # other endpoints are not limited
+            self.assertEqual(self.client.get('/ping').status_code, 200)
+            body = self.client.get('/metrics').data.decode()
+            self.assertIn(
+                'users_admission_rejections_total{endpoint="auth.login_user",'
+                'reason="rate"}', body)
+
+    def test_rate_limit_client_header(self):
+        """Ensure clients are keyed by the entry the trusted proxy added."""
+        self.app.config['ADMISSION_CLIENT_HEADER'] = 'X-Forwarded-For'
+        self.limit(rate=0.5, burst=1)
+
+        def login_via(forwarded_for):
+            return self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(email='joe@gmail.com', password='1')),
+                content_type='application/json',
+                headers={'X-Forwarded-For': forwarded_for}
+            )
+
+        with self.client:
+            self.assertEqual(login_via('192.0.2.1').status_code, 404)
+            self.assertEqual(login_via('192.0.2.1').status_code, 429)
+            # a forged leftmost entry does not buy a fresh bucket
+            self.assertEqual(
+                login_via('203.0.113.7, 192.0.2.1').status_code, 429)
+            self.assertEqual(
+                login_via('203.0.113.8, 192.0.2.1').status_code, 429)
+            self.assertEqual(login_via('192.0.2.2').status_code, 404)
+
+    def test_rate_limit_trusted_hops(self):
+        """Ensure the client entry is counted from the right."""
+        self.app.config['ADMISSION_CLIENT_HEADER'] = 'X-Forwarded-For'
+        self.app.config['ADMISSION_TRUSTED_HOPS'] = 2
+        self.limit(rate=0.5, burst=1)
+        with self.client:
+            response = self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(email='joe@gmail.com', password='1')),
+                content_type='application/json',
+                headers={
+                    'X-Forwarded-For': '203.0.113.7, 192.0.2.1, 10.0.0.1'}
+            )
+            self.assertEqual(response.status_code, 404)
+            response = self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(email='joe@gmail.com', password='1')),
+                content_type='application/json',
+                headers={
+                    'X-Forwarded-For': '198.51.100.1, 192.0.2.1, 10.0.0.2'}
+            )
+            self.assertEqual(response.status_code, 429)
+
+    def test_concurrency_limit(self):
+        """Ensure requests over the concurrency limit get a 503."""
+        self.limit(concurrency=1)
+        with self.client:
+            # slots are released after each request
+            self.assertEqual(login(self.client).status_code, 404)
+            self.assertEqual(login(self.client).status_code, 404)
+            semaphore = admission._semaphores['auth.login_user']
+            semaphore.acquire()
+            try:
+                response = login(self.client)
+            finally:
+                semaphore.release()
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(data['message'], 'Server busy. Please try again.')
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertEqual(login(self.client).status_code, 404)
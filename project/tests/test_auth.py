@@ -2,9 +2,17 @@
 
 
 import json
+import os
+import subprocess
+import sys
+import tempfile
 import time
+from unittest import mock
 
-from project import db
+import jwt
+
+from project import db, hashing_pool, key_ring
+from project.keys import generate_private_key_pem
 from project.api.models import User
 from project.tests.base import BaseTestCase
 from project.tests.utils import add_user
@@ -14,15 +22,16 @@ class TestAuthBlueprint(BaseTestCase):
 
     def test_user_registration(self):
         with self.client:
-            response = self.client.post(
-                '/auth/register',
-                data=json.dumps(dict(
-                    username='justatest',
-                    email='test@test.com',
-                    password='123456'
-                )),
-                content_type='application/json'
-            )
+            with self.assertMaxQueries(2):
+                response = self.client.post(
+                    '/auth/register',
+                    data=json.dumps(dict(
+                        username='justatest',
+                        email='test@test.com',
+                        password='123456'
+                    )),
+                    content_type='application/json'
+                )
             data = json.loads(response.data.decode())
             self.assertTrue(data['status'] == 'success')
             self.assertTrue(data['message'] == 'Successfully registered.')
@@ -33,21 +42,39 @@ class TestAuthBlueprint(BaseTestCase):
     def test_user_registration_duplicate_email(self):
         add_user('test', 'test@test.com', 'test')
         with self.client:
-            response = self.client.post(
-                '/auth/register',
-                data=json.dumps(dict(
-                    username='michael',
-                    email='test@test.com',
-                    password='test'
-                )),
-                content_type='application/json',
-            )
+            with self.assertMaxQueries(1):
+                response = self.client.post(
+                    '/auth/register',
+                    data=json.dumps(dict(
+                        username='michael',
+                        email='test@test.com',
+                        password='test'
+                    )),
+                    content_type='application/json',
+                )
             data = json.loads(response.data.decode())
             self.assertEqual(response.status_code, 400)
             self.assertIn(
                 'Sorry. That user already exists.', data['message'])
             self.assertIn('error', data['status'])
 
+    def test_user_registration_duplicate_skips_hashing(self):
+        add_user('test', 'test@test.com', 'test')
+        with mock.patch.object(
+                hashing_pool, 'generate_password_hash') as generate:
+            with self.client:
+                response = self.client.post(
+                    '/auth/register',
+                    data=json.dumps(dict(
+                        username='test',
+                        email='michael@realpython.com',
+                        password='test'
+                    )),
+                    content_type='application/json',
+                )
+        self.assertEqual(response.status_code, 400)
+        generate.assert_not_called()
+
     def test_user_registration_duplicate_username(self):
         add_user('test', 'test@test.com', 'test')
         with self.client:
@@ -68,11 +95,12 @@ class TestAuthBlueprint(BaseTestCase):
 
     def test_user_registration_invalid_json(self):
         with self.client:
-            response = self.client.post(
-                '/auth/register',
-                data=json.dumps(dict()),
-                content_type='application/json'
-            )
+            with self.assertMaxQueries(0):
+                response = self.client.post(
+                    '/auth/register',
+                    data=json.dumps(dict()),
+                    content_type='application/json'
+                )
             data = json.loads(response.data.decode())
             self.assertEqual(response.status_code, 400)
             self.assertIn('Invalid payload.', data['message'])
@@ -119,20 +147,46 @@ class TestAuthBlueprint(BaseTestCase):
     def test_registered_user_login(self):
         with self.client:
             add_user('test', 'test@test.com', 'test')
+            with self.assertMaxQueries(1):
+                response = self.client.post(
+                    '/auth/login',
+                    data=json.dumps(dict(
+                        email='test@test.com',
+                        password='test'
+                    )),
+                    content_type='application/json'
+                )
+            data = json.loads(response.data.decode())
+            self.assertTrue(data['status'] == 'success')
+            self.assertTrue(data['message'] == 'Successfully logged in.')
+            self.assertTrue(data['auth_token'])
+            self.assertTrue(response.content_type == 'application/json')
+            self.assertEqual(response.status_code, 200)
+
+    def test_login_email_is_case_insensitive(self):
+        add_user('test', 'Test@Test.com', 'test')
+        with self.client:
             response = self.client.post(
                 '/auth/login',
                 data=json.dumps(dict(
-                    email='test@test.com',
+                    email='test@test.COM',
                     password='test'
                 )),
                 content_type='application/json'
             )
             data = json.loads(response.data.decode())
-            self.assertTrue(data['status'] == 'success')
-            self.assertTrue(data['message'] == 'Successfully logged in.')
-            self.assertTrue(data['auth_token'])
-            self.assertTrue(response.content_type == 'application/json')
             self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['auth_token'])
+            response = self.client.post(
+                '/auth/register',
+                data=json.dumps(dict(
+                    username='michael',
+                    email='TEST@test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 400)
 
     def test_not_registered_user_login(self):
         with self.client:
@@ -163,19 +217,55 @@ class TestAuthBlueprint(BaseTestCase):
                 content_type='application/json'
             )
             # valid token logout
-            response = self.client.get(
-                '/auth/logout',
-                headers=dict(
-                    Authorization='Bearer ' + json.loads(
-                        resp_login.data.decode()
-                    )['auth_token']
+            with self.assertMaxQueries(2):
+                response = self.client.get(
+                    '/auth/logout',
+                    headers=dict(
+                        Authorization='Bearer ' + json.loads(
+                            resp_login.data.decode()
+                        )['auth_token']
+                    )
                 )
-            )
             data = json.loads(response.data.decode())
             self.assertTrue(data['status'] == 'success')
             self.assertTrue(data['message'] == 'Successfully logged out.')
             self.assertEqual(response.status_code, 200)
 
+    def test_logout_revokes_token(self):
+        add_user('test', 'test@test.com', 'test')
+        with self.client:
+            resp_login = self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(
+                    email='test@test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
+            auth_token = json.loads(resp_login.data.decode())['auth_token']
+            response = self.client.get(
+                '/auth/logout',
+                headers=dict(Authorization='Bearer ' + auth_token)
+            )
+            self.assertEqual(response.status_code, 200)
+            for url in ['/auth/logout', '/auth/status']:
+                response = self.client.get(
+                    url,
+                    headers=dict(Authorization='Bearer ' + auth_token)
+                )
+                data = json.loads(response.data.decode())
+                self.assertTrue(data['status'] == 'error')
+                self.assertTrue(
+                    data['message'] == 'Token revoked. Please log in again.')
+                self.assertEqual(response.status_code, 401)
+            response = self.client.post(
+                '/auth/introspect',
+                data=json.dumps(dict(tokens=[auth_token])),
+                content_type='application/json'
+            )
+            data = json.loads(response.data.decode())
+            self.assertFalse(data['data']['tokens'][0]['active'])
+
     def test_invalid_logout_expired_token(self):
         add_user('test', 'test@test.com', 'test')
         with self.client:
@@ -254,14 +344,15 @@ class TestAuthBlueprint(BaseTestCase):
                 )),
                 content_type='application/json'
             )
-            response = self.client.get(
-                '/auth/status',
-                headers=dict(
-                    Authorization='Bearer ' + json.loads(
-                        resp_login.data.decode()
-                    )['auth_token']
+            with self.assertMaxQueries(2):
+                response = self.client.get(
+                    '/auth/status',
+                    headers=dict(
+                        Authorization='Bearer ' + json.loads(
+                            resp_login.data.decode()
+                        )['auth_token']
+                    )
                 )
-            )
             data = json.loads(response.data.decode())
             self.assertTrue(data['status'] == 'success')
             self.assertTrue(data['data'] is not None)
@@ -310,3 +401,118 @@ class TestAuthBlueprint(BaseTestCase):
             self.assertTrue(
                 data['message'] == 'Something went wrong. Please contact us.')
             self.assertEqual(response.status_code, 401)
+
+    def test_login_rehashes_off_target_password(self):
+        user = add_user('test', 'test@test.com', 'test')
+        self.assertTrue(user.password.startswith('$2b$04$'))
+        self.app.config['BCRYPT_LOG_ROUNDS'] = 5
+        with self.client:
+            response = self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(
+                    email='test@test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+        user = User.query.filter_by(email='test@test.com').first()
+        self.assertTrue(user.password.startswith('$2b$05$'))
+
+    def test_introspect_tokens(self):
+        active = add_user('test', 'test@test.com', 'test')
+        inactive = add_user('test2', 'test2@test.com', 'test')
+        inactive.active = False
+        db.session.commit()
+        active_token = active.encode_auth_token(active.id).decode()
+        inactive_token = inactive.encode_auth_token(inactive.id).decode()
+        with self.client:
+            with self.assertMaxQueries(1):
+                response = self.client.post(
+                    '/auth/introspect',
+                    data=json.dumps(dict(tokens=[
+                        active_token, 'invalid', inactive_token,
+                        active_token
+                    ])),
+                    content_type='application/json'
+                )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['status'] == 'success')
+            self.assertEqual(data['data']['tokens'], [
+                {'active': True, 'sub': active.id, 'admin': False},
+                {'active': False,
+                 'message': 'Invalid token. Please log in again.'},
+                {'active': False, 'sub': inactive.id},
+                {'active': True, 'sub': active.id, 'admin': False}
+            ])
+
+    def test_introspect_tokens_invalid_json(self):
+        with self.client:
+            response = self.client.post(
+                '/auth/introspect',
+                data=json.dumps(dict(tokens='invalid')),
+                content_type='application/json'
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Invalid payload.', data['message'])
+            self.assertIn('error', data['status'])
+
+    def test_jwks_hs256(self):
+        with self.client:
+            response = self.client.get('/.well-known/jwks.json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data, {'keys': []})
+            self.assertIn('max-age=3600', response.headers['Cache-Control'])
+
+    def test_rs256_tokens_and_key_rotation(self):
+        user = add_user('test', 'test@test.com', 'test')
+        with tempfile.TemporaryDirectory() as keys_dir:
+            with open(os.path.join(keys_dir, '2017a.pem'), 'wb') as f:
+                f.write(generate_private_key_pem())
+            self.app.config['JWT_ALGORITHM'] = 'RS256'
+            self.app.config['JWT_KEYS_DIR'] = keys_dir
+            key_ring.init_app(self.app)
+            old_token = user.encode_auth_token(user.id)
+            self.assertEqual(
+                jwt.get_unverified_header(old_token)['kid'], '2017a')
+            # rotate: the new key signs, the old one still verifies
+            with open(os.path.join(keys_dir, '2017b.pem'), 'wb') as f:
+                f.write(generate_private_key_pem())
+            key_ring.init_app(self.app)
+            new_token = user.encode_auth_token(user.id)
+            self.assertEqual(
+                jwt.get_unverified_header(new_token)['kid'], '2017b')
+            self.assertEqual(User.decode_auth_token(old_token), user.id)
+            self.assertEqual(User.decode_auth_token(new_token), user.id)
+            response = self.client.get('/.well-known/jwks.json')
+            data = json.loads(response.data.decode())
+            self.assertEqual(
+                [key['kid'] for key in data['keys']], ['2017a', '2017b'])
+            self.assertTrue(all(key['alg'] == 'RS256' and key['n']
+                                for key in data['keys']))
+            # a token signed with SECRET_KEY is no longer accepted
+            forged = jwt.encode(
+                {'sub': user.id}, self.app.config['SECRET_KEY'] or 'secret',
+                algorithm='HS256', headers={'kid': '2017b'})
+            self.assertEqual(
+                User.decode_auth_token(forged),
+                'Invalid token. Please log in again.')
+
+
+class TestGreenLogin(BaseTestCase):
+    """Runs a gevent server in a subprocess, on its own engine"""
+    # the server's connections must see the user the test commits
+    transactional = False
+
+    def test_reads_are_served_during_login(self):
+        user = add_user('test', 'test@test.com', 'test')
+        env = dict(os.environ, APP_SETTINGS='project.config.TestingConfig')
+        result = subprocess.run(
+            [sys.executable, '-m', 'project.tests.green_login',
+             str(user.id), 'test@test.com', 'test'],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            timeout=60)
+        self.assertEqual(result.returncode, 0, result.stdout.decode())
@@ -0,0 +1,36 @@
+# project/tests/test_bench.py
+
+
+from project import bench
+from project.api.models import User
+from project.tests.base import BaseTestCase
+from project.tests.utils import add_user
+
+
+class TestBench(BaseTestCase):
+
+    def test_percentile(self):
+        timings = [float(i) for i in range(1, 101)]
+        self.assertEqual(bench.percentile(timings, 50), 50.0)
+        self.assertEqual(bench.percentile(timings, 99), 99.0)
+        self.assertEqual(bench.percentile([1.0], 99), 1.0)
+
+    def test_run(self):
+        add_user('test', 'test@test.com', 'test')
+        report = bench.run(
+            size=5, iterations=3, bcrypt_iterations=1, costs=[4])
+        self.assertEqual(report['meta']['size'], 5)
+        for name in ['jwt_encode', 'jwt_decode', 'jwt_decode_cached',
+                     'bcrypt_hash_cost_4', 'bcrypt_check_cost_4',
+                     'users_jsonify', 'authenticate_principal_query']:
+            self.assertIn(name, report['results'])
+            self.assertEqual(report['results'][name]['iterations'],
+                             1 if name.startswith('bcrypt') else 3)
+            self.assertTrue(report['results'][name]['ops_per_sec'] > 0)
+        self.assertNotIn('bcrypt_hash_cost_13', report['results'])
+        # seeded users are rolled back, existing ones are left alone
+        self.assertEqual(User.query.count(), 1)
+
+    def test_run_refuses_production(self):
+        self.app.config['BENCH_ENABLED'] = False
+        self.assertRaises(bench.BenchRefused, bench.run, 5, 3, 1, [4])
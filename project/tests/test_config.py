@@ -6,8 +6,11 @@ import unittest
 
 from flask import current_app
 from flask_testing import TestCase
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
 
-from project import create_app
+from project import create_app, db
+from project.pool import InstrumentedQueuePool
 
 app = create_app()
 
@@ -31,6 +34,7 @@ class TestDevelopmentConfig(TestCase):
         self.assertTrue(app.config['BCRYPT_LOG_ROUNDS'] == 4)
         self.assertTrue(app.config['TOKEN_EXPIRATION_DAYS'] == 30)
         self.assertTrue(app.config['TOKEN_EXPIRATION_SECONDS'] == 0)
+        self.assertFalse(app.config['SQLALCHEMY_POOL_PRE_PING'])
 
 class TestTestingConfig(TestCase):
     def create_app(self):
@@ -52,6 +56,24 @@ class TestTestingConfig(TestCase):
         self.assertTrue(app.config['BCRYPT_LOG_ROUNDS'] == 4)
         self.assertTrue(app.config['TOKEN_EXPIRATION_DAYS'] == 0)
         self.assertTrue(app.config['TOKEN_EXPIRATION_SECONDS'] == 3)
+        self.assertTrue(app.config['SQLALCHEMY_POOL_SIZE'] == 2)
+        self.assertTrue(app.config['JWT_ALGORITHM'] == 'HS256')
+        self.assertFalse(app.config['ADMISSION_LIMITS'])
+        self.assertFalse(app.config['SQLALCHEMY_REPLICA_URIS'])
+        self.assertFalse(app.config['SQLALCHEMY_POOL_PRE_PING'])
+
+    def test_pre_ping_only_on_pooled_connections(self):
+        url = make_url('postgresql://postgres@localhost/users_test')
+        app.config['SQLALCHEMY_POOL_PRE_PING'] = True
+        options = {}
+        db.apply_driver_hacks(app, url, options)
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertTrue(options['pool_events'])
+        app.config['SQLALCHEMY_POOL_MODE'] = 'pgbouncer'
+        options = {}
+        db.apply_driver_hacks(app, url, options)
+        self.assertIs(options['poolclass'], NullPool)
+        self.assertNotIn('pool_events', options)
 
 class TestProductionConfig(TestCase):
     def create_app(self):
@@ -68,6 +90,7 @@ class TestProductionConfig(TestCase):
         self.assertTrue(app.config['BCRYPT_LOG_ROUNDS'] == 13)
         self.assertTrue(app.config['TOKEN_EXPIRATION_DAYS'] == 30)
         self.assertTrue(app.config['TOKEN_EXPIRATION_SECONDS'] == 0)
+        self.assertFalse(app.config['SQLALCHEMY_POOL_PRE_PING'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+# project/tests/test_indexes.py
+
+
+import datetime
+import json
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from project import db, hashing_pool
+from project.api.models import User
+from project.tests.base import BaseTestCase
+
+
+@contextmanager
+def capture_queries(table):
+    """Collects the (statement, parameters) run against a table"""
+    queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and \
+                f'FROM {table}' in statement:
+            queries.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+class TestIndexes(BaseTestCase):
+    """Each hot query must be answerable from an index"""
+
+    def setUp(self):
+        super().setUp()
+        password = hashing_pool.generate_password_hash('test', 4)
+        now = datetime.datetime.utcnow()
+        db.session.execute(User.__table__.insert(), [{
+            'username': f'user{i}',
+            'email': f'user{i}@test.com',
+            'password': password,
+            'active': i % 2 == 0,
+            'admin': False,
+            'created_at': now - datetime.timedelta(seconds=i),
+            'updated_at': now
+        } for i in range(200)])
+        db.session.execute('ANALYZE users')
+        db.session.commit()
+
+    def explain(self, statement, parameters):
+        # tiny tables are cheapest to scan, so take that option away
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+        finally:
+            cursor.close()
+            db.session.rollback()
+
+    def assertUsesIndex(self, queries, marker, index):
+        matching = [query for query in queries if marker in query[0]]
+        self.assertTrue(matching, f'no query matching {marker!r}')
+        for statement, parameters in matching:
+            plan = self.explain(statement, parameters)
+            self.assertIn(index, plan, f'{statement}\n{plan}')
+
+    def test_login_email_lookup(self):
+        with capture_queries('users') as queries:
+            response = self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(
+                    email='User3@Test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertUsesIndex(
+            queries, 'lower(users.email)', 'ix_users_email_lower')
+
+    def test_registration_conflict_check(self):
+        with capture_queries('users') as queries:
+            response = self.client.post(
+                '/auth/register',
+                data=json.dumps(dict(
+                    username='michael',
+                    email='USER3@test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertUsesIndex(
+            queries, 'lower(users.email)', 'ix_users_email_lower')
+
+    def test_users_pages(self):
+        with capture_queries('users') as queries:
+            response = self.client.get('/users?limit=10')
+            cursor = json.loads(response.data.decode())['data']['next_cursor']
+            self.client.get(f'/users?limit=10&after={cursor}')
+        self.assertEqual(len([q for q in queries if 'LIMIT' in q[0]]), 2)
+        self.assertUsesIndex(queries, 'LIMIT', 'ix_users_created_at_id')
+
+    def test_active_users_page(self):
+        with capture_queries('users') as queries:
+            response = self.client.get('/users?limit=10&active=true')
+        data = json.loads(response.data.decode())
+        self.assertEqual(len(data['data']['users']), 10)
+        self.assertUsesIndex(
+            queries, 'LIMIT', 'ix_users_active_created_at_id')
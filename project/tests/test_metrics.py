@@ -0,0 +1,60 @@
+# project/tests/test_metrics.py
+
+
+from project import hashing_pool
+from project.hashing import HashingPoolFull
+from project.tests.base import BaseTestCase
+from project.tests.utils import add_user
+
+
+class TestMetrics(BaseTestCase):
+
+    def test_metrics(self):
+        """Ensure /metrics exposes request, SQL, bcrypt and JWT timings."""
+        user = add_user('test', 'test@test.com', 'test')
+        user.encode_auth_token(user.id)
+        self.client.get(f'/users/{user.id}')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        body = response.data.decode()
+        self.assertIn(
+            'users_request_duration_seconds_count{blueprint="users",'
+            'endpoint="users.get_single_user",method="GET",status="200"}',
+            body)
+        self.assertIn('users_request_sql_statements_bucket', body)
+        self.assertIn('users_sql_duration_seconds_count{statement="SELECT"}',
+                      body)
+        self.assertIn(
+            'users_bcrypt_duration_seconds_count{operation="hash"}', body)
+        self.assertIn(
+            'users_jwt_duration_seconds_count{operation="encode"}', body)
+        self.assertIn('users_bcrypt_in_flight 0.0', body)
+        self.assertIn('users_bcrypt_queued 0.0', body)
+
+    def test_cache_metrics(self):
+        """Ensure cache hits and misses are exported per cache."""
+        add_user('test', 'test@test.com', 'test')
+        self.client.get('/users')
+        self.client.get('/users')
+        body = self.client.get('/metrics').data.decode()
+        for cache in ('principal', 'token', 'response'):
+            self.assertIn(f'users_cache_hits_total{{cache="{cache}"}}', body)
+            self.assertIn(
+                f'users_cache_misses_total{{cache="{cache}"}}', body)
+
+    def test_bcrypt_rejections(self):
+        """Ensure hashing calls rejected by a full pool are counted."""
+        _, slots = hashing_pool._get_executor()
+        held = 0
+        while slots.acquire(blocking=False):
+            held += 1
+        try:
+            with self.assertRaises(HashingPoolFull):
+                hashing_pool.check_password_hash('$2b$04$x', 'test')
+        finally:
+            for _ in range(held):
+                slots.release()
+        body = self.client.get('/metrics').data.decode()
+        self.assertIn(
+            'users_bcrypt_rejections_total{operation="check"}', body)
@@ -0,0 +1,136 @@
+# project/tests/test_replicas.py
+
+
+import json
+from unittest import mock
+
+from sqlalchemy import event
+
+from project import db
+from project.pool import PRIMARY_COOKIE, ReplicaSet, replica_lag_sql
+from project.tests.base import BaseTestCase
+from project.tests.utils import add_user
+
+
+class TestReplicas(BaseTestCase):
+    """The test database doubles as its own replica, with no lag"""
+    # the replica connection must see the rows the test commits
+    transactional = False
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['SQLALCHEMY_REPLICA_URIS'] = [
+            self.app.config['SQLALCHEMY_DATABASE_URI']]
+        self.replica = db.replicas(self.app).engines[0]
+        self.replica_statements = []
+        event.listen(self.replica, 'before_cursor_execute', self.record)
+
+    def tearDown(self):
+        event.remove(self.replica, 'before_cursor_execute', self.record)
+        super().tearDown()
+        self.replica.dispose()
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        if 'FROM users' in statement:
+            self.replica_statements.append(statement)
+
+    def test_reads_go_to_replica(self):
+        user = add_user('test', 'test@test.com', 'test')
+        with self.client:
+            response = self.client.get(f'/users/{user.id}')
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(PRIMARY_COOKIE, response.headers.get(
+                'Set-Cookie', ''))
+        self.assertTrue(self.replica_statements)
+
+    def test_writes_stick_to_primary(self):
+        with self.client:
+            response = self.client.post(
+                '/auth/register',
+                data=json.dumps(dict(
+                    username='test',
+                    email='test@test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 201)
+            self.assertIn(PRIMARY_COOKIE, response.headers['Set-Cookie'])
+            # the client reads its own write from the primary
+            response = self.client.get('/users')
+            data = json.loads(response.data.decode())
+            self.assertEqual(len(data['data']['users']), 1)
+        self.assertEqual(self.replica_statements, [])
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        user = add_user('test', 'test@test.com', 'test')
+        with mock.patch.object(ReplicaSet, 'lag', return_value=60.0):
+            with self.client:
+                response = self.client.get(f'/users/{user.id}')
+                self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.replica_statements, [])
+
+    def test_replica_lag(self):
+        replicas = db.replicas(self.app)
+        self.assertEqual(replicas.lag(self.replica), 0)
+        self.assertIs(replicas.choose(), self.replica)
+        self.assertEqual(
+            db.pool_stats()['replicas'][0]['lag_seconds'], 0)
+
+    def in_recovery_replica(self, server_version_info, lag):
+        engine = mock.MagicMock()
+        connection = engine.connect.return_value.__enter__.return_value
+        connection.dialect.server_version_info = server_version_info
+        connection.execute.return_value.scalar.return_value = lag
+        return engine, connection
+
+    def test_caught_up_replica_lag(self):
+        engine, connection = self.in_recovery_replica((10, 4), 0)
+        replicas = ReplicaSet([engine], 5, 1)
+        self.assertEqual(replicas.lag(engine), 0)
+        self.assertIs(replicas.choose(), engine)
+        sql = str(connection.execute.call_args[0][0])
+        self.assertIn(
+            'pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()', sql)
+
+    def test_lagging_in_recovery_replica(self):
+        engine, connection = self.in_recovery_replica((9, 6), 30)
+        replicas = ReplicaSet([engine], 5, 1)
+        self.assertEqual(replicas.lag(engine), 30)
+        self.assertIsNone(replicas.choose())
+        sql = str(connection.execute.call_args[0][0])
+        self.assertIn(
+            'pg_last_xlog_receive_location() = '
+            'pg_last_xlog_replay_location()', sql)
+
+    def test_disconnected_replica_lag(self):
+        # receive = replay on a standby whose receiver stopped is not
+        # caught up; the query then falls back to the replay age
+        engine, connection = self.in_recovery_replica((10, 4), 600)
+        replicas = ReplicaSet([engine], 5, 1)
+        self.assertEqual(replicas.lag(engine), 600)
+        self.assertIsNone(replicas.choose())
+        sql = str(connection.execute.call_args[0][0])
+        self.assertIn(
+            'pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() AND '
+            'EXISTS (SELECT 1 FROM pg_stat_wal_receiver '
+            "WHERE status = 'streaming')", sql)
+
+    def test_never_replayed_replica_lag(self):
+        engine, connection = self.in_recovery_replica((10, 4), None)
+        replicas = ReplicaSet([engine], 5, 1)
+        self.assertIsNone(replicas.lag(engine))
+        self.assertIsNone(replicas.choose())
+
+    def test_replica_lag_sql_without_wal_receiver_view(self):
+        # before 9.6 the receiver state is unknown, so no shortcut
+        sql = str(replica_lag_sql((9, 5)))
+        self.assertNotIn('receive', sql)
+        self.assertIn('pg_last_xact_replay_timestamp()', sql)
+
+    def test_replica_lag_sql_runs(self):
+        # the test database is not a standby, so every branch must parse
+        with self.replica.connect() as connection:
+            sql = replica_lag_sql(connection.dialect.server_version_info)
+            self.assertEqual(connection.execute(sql).scalar(), 0)
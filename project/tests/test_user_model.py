@@ -1,10 +1,13 @@
 # project/tests/test_user_model.py
 
 
+from unittest import mock
+
 from sqlalchemy.exc import IntegrityError
 
-from project import db
+from project import db, hashing_pool, token_cache
 from project.api.models import User
+from project.hashing import calibrate_log_rounds
 from project.tests.base import BaseTestCase
 from project.tests.utils import add_user
 
@@ -31,6 +34,15 @@ class TestUserModel(BaseTestCase):
         self.assertTrue(isinstance(auth_token, bytes))
         self.assertEqual(User.decode_auth_token(auth_token), user.id)
 
+    def test_decode_auth_token_is_cached(self):
+        user = add_user('justatest', 'test@test.com', 'test')
+        auth_token = user.encode_auth_token(user.id)
+        self.assertEqual(User.decode_auth_token(auth_token), user.id)
+        self.assertEqual(token_cache.stats()['misses'], 1)
+        self.assertEqual(User.decode_auth_token(auth_token), user.id)
+        self.assertEqual(User.decode_auth_token(auth_token.decode()), user.id)
+        self.assertEqual(token_cache.stats()['hits'], 2)
+
     def test_add_user_duplicate_username(self):
         add_user('justatest', 'test@test.com', 'test')
         duplicate_user = User(
@@ -51,7 +63,62 @@ class TestUserModel(BaseTestCase):
         db.session.add(duplicate_user)
         self.assertRaises(IntegrityError, db.session.commit)
 
+    def test_insert_unique(self):
+        user_id, conflict = User.insert_unique(
+            'justatest', 'test@test.com', 'test')
+        self.assertIsNone(conflict)
+        user = User.query.get(user_id)
+        self.assertEqual(user.username, 'justatest')
+        self.assertTrue(user.active)
+        self.assertFalse(user.admin)
+        self.assertTrue(user.created_at)
+        self.assertEqual(
+            User.insert_unique('justatest', 'test@test2.com', 'test'),
+            (None, 'username'))
+        self.assertEqual(
+            User.insert_unique('justatest2', 'test@test.com', 'test'),
+            (None, 'email'))
+        self.assertRaises(
+            ValueError, User.insert_unique, 'justatest2', 'test@test2.com', '')
+
+    def test_insert_unique_reports_email_first(self):
+        add_user('justatest', 'test@test.com', 'test')
+        add_user('justatest2', 'test@test2.com', 'test')
+        self.assertEqual(
+            User.insert_unique('justatest', 'TEST@test.com', 'test'),
+            (None, 'email'))
+        self.assertEqual(
+            User.insert_unique('justatest', 'test@test2.com', 'test'),
+            (None, 'email'))
+
+    def test_insert_unique_race(self):
+        """A row inserted after the check is reported, not raised."""
+        add_user('justatest', 'test@test.com', 'test')
+        with mock.patch.object(
+                User, 'conflicting_field', side_effect=[None, 'email']):
+            self.assertEqual(
+                User.insert_unique('justatest2', 'test@test.com', 'test'),
+                (None, 'email'))
+        self.assertEqual(User.query.count(), 1)
+
     def test_passwords_are_random(self):
         user_one = add_user('justatest', 'test@test.com', 'test')
         user_two = add_user('justatest2', 'test@test2.com', 'test')
         self.assertNotEqual(user_one.password, user_two.password)
+
+    def test_passwords_are_hashed_on_pool(self):
+        completed = hashing_pool.stats()['completed']
+        user = add_user('justatest', 'test@test.com', 'test')
+        self.assertEqual(hashing_pool.stats()['completed'], completed + 1)
+        self.assertTrue(hashing_pool.check_password_hash(user.password, 'test'))
+        self.assertFalse(
+            hashing_pool.check_password_hash(user.password, 'nottest'))
+
+    def test_calibrate_log_rounds_uses_median(self):
+        # one slow outlier per cost must not lower the pick
+        timings = iter([0, 0, 0, 1, 0, 0] * 3)
+        with mock.patch('project.hashing._generate_password_hash'), \
+                mock.patch('project.hashing.time.monotonic',
+                           side_effect=lambda: next(timings)):
+            self.assertEqual(
+                calibrate_log_rounds(10, 4, 6, samples=3), 6)
@@ -4,8 +4,11 @@
 import json
 import datetime
 
-from project import db
+from sqlalchemy import event
+
+from project import db, principal_cache
 from project.api.models import User
+from project.api.utils import load_principal, load_principals
 from project.tests.base import BaseTestCase
 from project.tests.utils import add_user
 
@@ -15,12 +18,24 @@ class TestUserService(BaseTestCase):
 
     def test_users(self):
         """Ensure the /ping route behaves correctly."""
-        response = self.client.get('/ping')
+        with self.assertMaxQueries(0):
+            response = self.client.get('/ping')
         data = json.loads(response.data.decode())
         self.assertEqual(response.status_code, 200)
         self.assertIn('pong!', data['message'])
         self.assertIn('success', data['status'])
 
+    def test_pool_status(self):
+        """Ensure the /ping/pool route reports pool statistics."""
+        response = self.client.get('/ping/pool')
+        data = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('success', data['status'])
+        self.assertEqual(data['data']['size'], 2)
+        self.assertIn('checked_out', data['data'])
+        self.assertIn('overflow', data['data'])
+        self.assertIn('wait_ms_total', data['data'])
+
     def test_add_user(self):
         """Ensure a new user can be added to the database."""
         add_user('test', 'test@test.com', 'test')
@@ -38,20 +53,21 @@ class TestUserService(BaseTestCase):
                 )),
                 content_type='application/json'
             )
-            response = self.client.post(
-                '/users',
-                data=json.dumps(dict(
-                    username='michael',
-                    email='michael@realpython.com',
-                    password='test'
-                )),
-                content_type='application/json',
-                headers=dict(
-                    Authorization='Bearer ' + json.loads(
-                        resp_login.data.decode()
-                    )['auth_token']
+            with self.assertMaxQueries(3):
+                response = self.client.post(
+                    '/users',
+                    data=json.dumps(dict(
+                        username='michael',
+                        email='michael@realpython.com',
+                        password='test'
+                    )),
+                    content_type='application/json',
+                    headers=dict(
+                        Authorization='Bearer ' + json.loads(
+                            resp_login.data.decode()
+                        )['auth_token']
+                    )
                 )
-            )
             data = json.loads(response.data.decode())
             self.assertEqual(response.status_code, 201)
             self.assertIn('michael@realpython.com was added!', data['message'])
@@ -69,20 +85,21 @@ class TestUserService(BaseTestCase):
                 )),
                 content_type='application/json'
             )
-            response = self.client.post(
-                '/users',
-                data=json.dumps(dict(
-                    username='michael',
-                    email='michael@realpython.com',
-                    password='test'
-                )),
-                content_type='application/json',
-                headers=dict(
-                    Authorization='Bearer ' + json.loads(
-                        resp_login.data.decode()
-                    )['auth_token']
+            with self.assertMaxQueries(1):
+                response = self.client.post(
+                    '/users',
+                    data=json.dumps(dict(
+                        username='michael',
+                        email='michael@realpython.com',
+                        password='test'
+                    )),
+                    content_type='application/json',
+                    headers=dict(
+                        Authorization='Bearer ' + json.loads(
+                            resp_login.data.decode()
+                        )['auth_token']
+                    )
                 )
-            )
             data = json.loads(response.data.decode())
             self.assertTrue(data['status'] == 'error')
             self.assertTrue(
@@ -105,20 +122,21 @@ class TestUserService(BaseTestCase):
                 )),
                 content_type='application/json'
             )
-            response = self.client.post(
-                '/users',
-                data=json.dumps(dict(
-                    username='michael',
-                    email='michael@realpython.com',
-                    password='test'
-                )),
-                content_type='application/json',
-                headers=dict(
-                    Authorization='Bearer ' + json.loads(
-                        resp_login.data.decode()
-                    )['auth_token']
+            with self.assertMaxQueries(1):
+                response = self.client.post(
+                    '/users',
+                    data=json.dumps(dict(
+                        username='michael',
+                        email='michael@realpython.com',
+                        password='test'
+                    )),
+                    content_type='application/json',
+                    headers=dict(
+                        Authorization='Bearer ' + json.loads(
+                            resp_login.data.decode()
+                        )['auth_token']
+                    )
                 )
-            )
             data = json.loads(response.data.decode())
             self.assertTrue(data['status'] == 'error')
             self.assertTrue(
@@ -260,10 +278,48 @@ class TestUserService(BaseTestCase):
                     )['auth_token']
                 )
             )
+            with self.assertMaxQueries(1):
+                response = self.client.post(
+                    '/users',
+                    data=json.dumps(dict(
+                        username='michael',
+                        email='michael@realpython.com',
+                        password='test'
+                    )),
+                    content_type='application/json',
+                    headers=dict(
+                        Authorization='Bearer ' + json.loads(
+                            resp_login.data.decode()
+                        )['auth_token']
+                    )
+                )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(
+                'Sorry. That email already exists.', data['message'])
+            self.assertIn('fail', data['status'])
+
+    def test_add_user_duplicate_username(self):
+        """Ensure error is thrown if the username already exists."""
+        add_user('test', 'test@test.com', 'test')
+        # update user
+        user = User.query.filter_by(email='test@test.com').first()
+        user.admin = True
+        db.session.commit()
+        with self.client:
+            # user login
+            resp_login = self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(
+                    email='test@test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
             response = self.client.post(
                 '/users',
                 data=json.dumps(dict(
-                    username='michael',
+                    username='test',
                     email='michael@realpython.com',
                     password='test'
                 )),
@@ -277,14 +333,15 @@ class TestUserService(BaseTestCase):
             data = json.loads(response.data.decode())
             self.assertEqual(response.status_code, 400)
             self.assertIn(
-                'Sorry. That email already exists.', data['message'])
+                'Sorry. That username already exists.', data['message'])
             self.assertIn('fail', data['status'])
 
     def test_single_user(self):
         """Ensure get single user behaves correctly."""
         user = add_user('michael', 'michael@realpython.com', 'test')
         with self.client:
-            response = self.client.get(f'/users/{user.id}')
+            with self.assertMaxQueries(1):
+                response = self.client.get(f'/users/{user.id}')
             data = json.loads(response.data.decode())
             self.assertEqual(response.status_code, 200)
             self.assertTrue('created_at' in data['data'])
@@ -304,7 +361,7 @@ class TestUserService(BaseTestCase):
     def test_single_user_incorrect_id(self):
         """Ensure error is thrown if the id does not exist."""
         with self.client:
-            response = self.client.get('/users/999')
+            response = self.client.get('/users/999999999')
             data = json.loads(response.data.decode())
             self.assertEqual(response.status_code, 404)
             self.assertIn('User does not exist', data['message'])
@@ -316,7 +373,8 @@ class TestUserService(BaseTestCase):
         add_user('michael', 'michael@realpython.com', 'test', created)
         add_user('fletcher', 'fletcher@realpython.com', 'test')
         with self.client:
-            response = self.client.get('/users')
+            with self.assertMaxQueries(1):
+                response = self.client.get('/users')
             data = json.loads(response.data.decode())
             self.assertEqual(response.status_code, 200)
             self.assertEqual(len(data['data']['users']), 2)
@@ -329,3 +387,423 @@ class TestUserService(BaseTestCase):
             self.assertIn(
                 'fletcher@realpython.com', data['data']['users'][0]['email'])
             self.assertIn('success', data['status'])
+
+    def test_all_users_paginated(self):
+        """Ensure get all users pages through users with a cursor."""
+        now = datetime.datetime.utcnow()
+        add_user('michael', 'michael@realpython.com', 'test',
+                 now - datetime.timedelta(days=2))
+        add_user('fletcher', 'fletcher@realpython.com', 'test',
+                 now - datetime.timedelta(days=1))
+        add_user('justatest', 'test@test.com', 'test', now)
+        with self.client:
+            response = self.client.get('/users?limit=2')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(data['data']['users']), 2)
+            self.assertIn('justatest', data['data']['users'][0]['username'])
+            self.assertIn('fletcher', data['data']['users'][1]['username'])
+            self.assertTrue(data['data']['next_cursor'])
+            response = self.client.get(
+                f'/users?limit=2&after={data["data"]["next_cursor"]}')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(data['data']['users']), 1)
+            self.assertIn('michael', data['data']['users'][0]['username'])
+            self.assertIsNone(data['data']['next_cursor'])
+
+    def test_all_users_active(self):
+        """Ensure get all users can be filtered on active."""
+        add_user('michael', 'michael@realpython.com', 'test')
+        user = add_user('fletcher', 'fletcher@realpython.com', 'test')
+        user.active = False
+        db.session.commit()
+        with self.client:
+            response = self.client.get('/users?active=true')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [u['username'] for u in data['data']['users']], ['michael'])
+            response = self.client.get('/users?active=false')
+            data = json.loads(response.data.decode())
+            self.assertEqual(
+                [u['username'] for u in data['data']['users']], ['fletcher'])
+            response = self.client.get('/users?active=blah')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Invalid pagination parameters.', data['message'])
+            # the filter holds for streams and id lookups too
+            response = self.client.get('/users?stream=1&active=true')
+            self.assertEqual(
+                [json.loads(line)['username']
+                 for line in response.data.decode().splitlines()],
+                ['michael'])
+            michael = User.query.filter_by(username='michael').first()
+            response = self.client.get(
+                f'/users?ids={michael.id},{user.id}&active=true')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['data']['users'][1], None)
+            self.assertEqual(data['data']['missing'], [user.id])
+            for url in ('/users?stream=1&active=blah',
+                        f'/users?ids={user.id}&active=blah'):
+                response = self.client.get(url)
+                data = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('Invalid active filter.', data['message'])
+
+    def test_all_users_invalid_cursor(self):
+        """Ensure error is thrown if the cursor is malformed."""
+        with self.client:
+            response = self.client.get('/users?after=blah')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Invalid pagination parameters.', data['message'])
+            self.assertIn('fail', data['status'])
+
+    def test_all_users_invalid_limit(self):
+        """Ensure error is thrown if the limit is not a positive integer."""
+        with self.client:
+            response = self.client.get('/users?limit=0')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Invalid pagination parameters.', data['message'])
+            self.assertIn('fail', data['status'])
+
+    def test_all_users_stream(self):
+        """Ensure get all users can stream newline-delimited JSON."""
+        created = datetime.datetime.utcnow() + datetime.timedelta(-30)
+        add_user('michael', 'michael@realpython.com', 'test', created)
+        add_user('fletcher', 'fletcher@realpython.com', 'test')
+        with self.client:
+            response = self.client.get('/users?stream=1')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            lines = response.data.decode().splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertIn('fletcher', json.loads(lines[0])['username'])
+            self.assertIn('michael', json.loads(lines[1])['username'])
+            response = self.client.get(
+                '/users', headers=dict(Accept='application/x-ndjson'))
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            self.assertEqual(len(response.data.decode().splitlines()), 2)
+
+    def test_add_user_admin_revoked(self):
+        """Ensure a cached principal is invalidated when the user changes."""
+        add_user('test', 'test@test.com', 'test')
+        # update user
+        user = User.query.filter_by(email='test@test.com').first()
+        user.admin = True
+        db.session.commit()
+        with self.client:
+            resp_login = self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(
+                    email='test@test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
+            headers = dict(
+                Authorization='Bearer ' + json.loads(
+                    resp_login.data.decode()
+                )['auth_token']
+            )
+            response = self.client.post(
+                '/users',
+                data=json.dumps(dict(
+                    username='michael',
+                    email='michael@realpython.com',
+                    password='test'
+                )),
+                content_type='application/json',
+                headers=headers
+            )
+            self.assertEqual(response.status_code, 201)
+            user = User.query.filter_by(email='test@test.com').first()
+            user.admin = False
+            db.session.commit()
+            response = self.client.post(
+                '/users',
+                data=json.dumps(dict(
+                    username='fletcher',
+                    email='fletcher@realpython.com',
+                    password='test'
+                )),
+                content_type='application/json',
+                headers=headers
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 401)
+            self.assertTrue(
+                data['message'] == 'You do not have permission to do that.')
+
+    def test_import_users_csv(self):
+        """Ensure users can be bulk imported from CSV."""
+        add_user('test', 'test@test.com', 'test')
+        # update user
+        user = User.query.filter_by(email='test@test.com').first()
+        user.admin = True
+        db.session.commit()
+        with self.client:
+            resp_login = self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(
+                    email='test@test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
+            response = self.client.post(
+                '/users/import',
+                data='username,email,password,password_hash\n'
+                     f'michael,michael@realpython.com,,{user.password}\n'
+                     f'fletcher,test@test.com,,{user.password}\n'
+                     'nopassword,nopassword@realpython.com,,\n'
+                     f'michael,michael@mherman.org,,{user.password}\n'
+                     'plain,plain@realpython.com,test,\n'
+                     'short,short@realpython.com,,$2b$\n'
+                     f'cut,cut@realpython.com,,{user.password[:-1]}\n',
+                content_type='text/csv',
+                headers=dict(
+                    Authorization='Bearer ' + json.loads(
+                        resp_login.data.decode()
+                    )['auth_token']
+                )
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('success', data['status'])
+            self.assertEqual(data['data']['inserted'], 1)
+            self.assertEqual(
+                [(c['line'], c['field']) for c in data['data']['conflicts']],
+                [(5, 'username'), (3, 'email')])
+            self.assertEqual(
+                [e['line'] for e in data['data']['errors']], [4, 6, 7, 8])
+            # plain passwords are left to manage.py import_users
+            self.assertEqual(
+                data['data']['errors'][1]['message'],
+                'Plain passwords are not accepted here; send password_hash.')
+            # malformed hashes would fail every login of the account
+            self.assertEqual(
+                [e['message'] for e in data['data']['errors'][2:]],
+                ['Invalid password hash.'] * 2)
+            imported = User.query.filter_by(username='michael').first()
+            self.assertEqual(imported.email, 'michael@realpython.com')
+            self.assertEqual(imported.password, user.password)
+
+    def test_import_users_ndjson_prehashed(self):
+        """Ensure pre-hashed passwords are imported as is."""
+        add_user('test', 'test@test.com', 'test')
+        # update user
+        user = User.query.filter_by(email='test@test.com').first()
+        user.admin = True
+        db.session.commit()
+        with self.client:
+            resp_login = self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(
+                    email='test@test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
+            response = self.client.post(
+                '/users/import',
+                data=json.dumps(dict(
+                    username='michael',
+                    email='michael@realpython.com',
+                    password_hash=user.password
+                )) + '\n',
+                content_type='application/x-ndjson',
+                headers=dict(
+                    Authorization='Bearer ' + json.loads(
+                        resp_login.data.decode()
+                    )['auth_token']
+                )
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['data']['inserted'], 1)
+            imported = User.query.filter_by(username='michael').first()
+            self.assertEqual(imported.password, user.password)
+
+    def test_import_users_not_admin(self):
+        """Ensure only admins can bulk import users."""
+        add_user('test', 'test@test.com', 'test')
+        with self.client:
+            resp_login = self.client.post(
+                '/auth/login',
+                data=json.dumps(dict(
+                    email='test@test.com',
+                    password='test'
+                )),
+                content_type='application/json'
+            )
+            response = self.client.post(
+                '/users/import',
+                data='username,email,password\n',
+                content_type='text/csv',
+                headers=dict(
+                    Authorization='Bearer ' + json.loads(
+                        resp_login.data.decode()
+                    )['auth_token']
+                )
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 401)
+            self.assertTrue(
+                data['message'] == 'You do not have permission to do that.')
+
+    def test_single_user_not_modified(self):
+        """Ensure get single user answers conditional requests with 304."""
+        user = add_user('michael', 'michael@realpython.com', 'test')
+        with self.client:
+            response = self.client.get(f'/users/{user.id}')
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            last_modified = response.headers['Last-Modified']
+            with self.assertMaxQueries(1):
+                response = self.client.get(
+                    f'/users/{user.id}', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            response = self.client.get(
+                f'/users/{user.id}',
+                headers={'If-Modified-Since': last_modified})
+            self.assertEqual(response.status_code, 304)
+            user.username = 'fletcher'
+            db.session.commit()
+            response = self.client.get(
+                f'/users/{user.id}', headers={'If-None-Match': etag})
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            self.assertIn('fletcher', data['data']['username'])
+
+    def test_all_users_not_modified(self):
+        """Ensure get all users answers conditional requests with 304."""
+        add_user('michael', 'michael@realpython.com', 'test')
+        with self.client:
+            response = self.client.get('/users')
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            self.assertTrue(response.headers['Last-Modified'])
+            with self.assertMaxQueries(1):
+                response = self.client.get(
+                    '/users', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get(
+                '/users?limit=1', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            add_user('fletcher', 'fletcher@realpython.com', 'test')
+            response = self.client.get(
+                '/users', headers={'If-None-Match': etag})
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(data['data']['users']), 2)
+
+    def test_all_users_cached(self):
+        """Ensure get all users is served from cache until a user write."""
+        add_user('michael', 'michael@realpython.com', 'test')
+        with self.client:
+            response = self.client.get('/users?limit=10')
+            self.assertEqual(response.status_code, 200)
+            with self.assertMaxQueries(0):
+                cached = self.client.get('/users?limit=10')
+            self.assertEqual(cached.status_code, 200)
+            self.assertEqual(cached.data, response.data)
+            self.assertEqual(cached.headers['ETag'], response.headers['ETag'])
+            with self.assertMaxQueries(0):
+                response = self.client.get(
+                    '/users?limit=10',
+                    headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 304)
+            add_user('fletcher', 'fletcher@realpython.com', 'test')
+            response = self.client.get('/users?limit=10')
+            data = json.loads(response.data.decode())
+            self.assertEqual(len(data['data']['users']), 2)
+
+    def test_single_user_fields(self):
+        """Ensure get single user only returns the requested fields."""
+        user = add_user('michael', 'michael@realpython.com', 'test')
+        with self.client:
+            with self.assertMaxQueries(1) as statements:
+                response = self.client.get(
+                    f'/users/{user.id}?fields=id,username')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                data['data'], {'id': user.id, 'username': 'michael'})
+            self.assertNotIn('password', statements[0])
+            self.assertNotIn('email', statements[0])
+
+    def test_all_users_fields(self):
+        """Ensure get all users only returns the requested fields."""
+        add_user('michael', 'michael@realpython.com', 'test')
+        with self.client:
+            with self.assertMaxQueries(1) as statements:
+                response = self.client.get('/users?fields=username')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['data']['users'], [{'username': 'michael'}])
+            self.assertNotIn('password', statements[-1])
+            response = self.client.get('/users?stream=1&fields=id,email')
+            self.assertEqual(
+                set(json.loads(response.data.decode())), {'id', 'email'})
+
+    def test_all_users_invalid_fields(self):
+        """Ensure error is thrown if an unknown field is requested."""
+        with self.client:
+            response = self.client.get('/users?fields=username,password')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Invalid fields.', data['message'])
+            self.assertIn('fail', data['status'])
+
+    def test_users_by_ids(self):
+        """Ensure users can be looked up in bulk by id."""
+        michael = add_user('michael', 'michael@realpython.com', 'test')
+        fletcher = add_user('fletcher', 'fletcher@realpython.com', 'test')
+        with self.client:
+            with self.assertMaxQueries(1):
+                response = self.client.get(
+                    f'/users?ids={fletcher.id},999,{michael.id}'
+                    '&fields=id,username')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['data']['users'], [
+                {'id': fletcher.id, 'username': 'fletcher'},
+                None,
+                {'id': michael.id, 'username': 'michael'}
+            ])
+            self.assertEqual(data['data']['missing'], [999])
+
+    def test_users_by_ids_invalid(self):
+        """Ensure error is thrown for malformed or too many ids."""
+        with self.client:
+            response = self.client.get('/users?ids=1,blah')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Invalid ids.', data['message'])
+            ids = ','.join(str(i) for i in range(101))
+            response = self.client.get(f'/users?ids={ids}')
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Too many ids (max 100).', data['message'])
+
+    def test_principal_invalidated_during_load_is_not_cached(self):
+        """Ensure a principal read before an invalidation is not cached."""
+        user = add_user('michael', 'michael@realpython.com', 'test')
+
+        def invalidate(*args):
+            principal_cache.invalidate(user.id)
+
+        for load in (load_principal, lambda user_id: load_principals(
+                [user_id])[user_id]):
+            event.listen(db.engine, 'before_cursor_execute', invalidate)
+            try:
+                self.assertEqual(load(user.id).id, user.id)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', invalidate)
+            self.assertIsNone(principal_cache.get(user.id))
@@ -2,7 +2,9 @@
 
 
 import datetime
+from contextlib import contextmanager
 
+from sqlalchemy import event
 
 from project import db
 from project.api.models import User
@@ -17,3 +19,25 @@ def add_user(username, email, password, created_at=datetime.datetime.utcnow()):
     db.session.add(user)
     db.session.commit()
     return user
+
+
+# the savepoints of the transactional test harness stand in for the
+# endpoint's COMMIT and ROLLBACK, which are not counted either
+SAVEPOINT_STATEMENTS = (
+    'SAVEPOINT ', 'RELEASE SAVEPOINT ', 'ROLLBACK TO SAVEPOINT ')
+
+
+@contextmanager
+def count_queries():
+    """Collects the SQL statements run inside the block"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(SAVEPOINT_STATEMENTS):
+            statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)